@@ -0,0 +1,106 @@
+# bench_compose.py — бенчмарк студийной композиции (imaging.compose_subject_on_bg).
+#
+# Сравнивает текущую реализацию на NumPy/OpenCV с прежней на PIL (полноразмерный
+# слой тени, GaussianBlur(12), два alpha_composite) по скорости и по картинке.
+#
+#   python3 bench_compose.py [--repeat 10] [--tolerance 3.0]
+#
+# Код возврата 1, если средняя разница пикселей больше --tolerance.
+
+import argparse
+import io
+import statistics
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+import imaging
+
+
+def compose_reference(subject_png: bytes, bg_img: Image.Image) -> Image.Image:
+    """Прежняя реализация на PIL — эталон для сравнения."""
+    subj = Image.open(io.BytesIO(subject_png)).convert("RGBA")
+
+    canvas_w, canvas_h = bg_img.size
+    target_h = int(canvas_h * 0.75)
+    scale = target_h / subj.height
+    subj = subj.resize((int(subj.width * scale), target_h), Image.LANCZOS)
+
+    alpha = subj.getchannel('A')
+    shadow = Image.new("RGBA", subj.size, (0, 0, 0, 160))
+    shadow.putalpha(alpha)
+    shadow = shadow.filter(ImageFilter.GaussianBlur(12))
+
+    out = bg_img.copy()
+    x = (canvas_w - subj.width) // 2
+    y = canvas_h - subj.height - int(canvas_h * 0.05)
+
+    out.alpha_composite(shadow, (x + 8, y + 18))
+    out.alpha_composite(subj, (x, y))
+    return out
+
+
+def make_subject() -> bytes:
+    """Вырезка «как от Pixelcut»: объект с мягким краем и широкими прозрачными полями."""
+    img = Image.new("RGBA", (1200, 1600), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    draw.rounded_rectangle((300, 250, 900, 1400), radius=120, fill=(180, 40, 60, 255))
+    draw.ellipse((420, 380, 780, 740), fill=(240, 220, 90, 255))
+    alpha = img.getchannel("A").filter(ImageFilter.GaussianBlur(2))
+    img.putalpha(alpha)
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def make_background(size: tuple[int, int]) -> Image.Image:
+    w, h = size
+    gx = np.linspace(60, 220, w, dtype=np.float32)[None, :]
+    gy = np.linspace(40, 200, h, dtype=np.float32)[:, None]
+    rgb = np.stack([gx + 0 * gy, gy + 0 * gx, (gx + gy) / 2], axis=2)
+    noise = np.random.default_rng(0).normal(0, 6, rgb.shape)
+    return Image.fromarray(np.clip(rgb + noise, 0, 255).astype(np.uint8), "RGB")
+
+
+def timed(fn, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--tolerance", type=float, default=3.0, help="допустимая средняя разница, 0..255")
+    args = parser.parse_args()
+
+    subject = make_subject()
+    ok = True
+    print(f"{'размер':>10} {'PIL, мс':>9} {'NumPy, мс':>10} {'ускорение':>10} {'ср.разн.':>9} {'p99':>5} {'макс':>5}")
+    for size in ((1024, 1024), (1024, 1792), (1792, 1024)):
+        bg = make_background(size)
+        bg_rgba = bg.convert("RGBA")
+
+        ref = np.asarray(compose_reference(subject, bg_rgba).convert("RGB"), dtype=np.int16)
+        new = np.asarray(imaging.compose_subject_on_bg(subject, bg), dtype=np.int16)
+        diff = np.abs(ref - new)
+
+        t_ref = timed(lambda: compose_reference(subject, bg_rgba), args.repeat)
+        t_new = timed(lambda: imaging.compose_subject_on_bg(subject, bg), args.repeat)
+
+        mean = float(diff.mean())
+        ok &= mean <= args.tolerance
+        print(f"{size[0]}x{size[1]:<5} {t_ref * 1000:9.1f} {t_new * 1000:10.1f} {t_ref / t_new:9.2f}x "
+              f"{mean:9.3f} {int(np.percentile(diff, 99)):5d} {int(diff.max()):5d}")
+
+    if not ok:
+        print(f"Разница с эталоном больше допустимой ({args.tolerance})")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,372 @@
+# bench_load.py — нагрузочный прогон бота целиком на локальных заглушках.
+#
+# Поднимает фейковые Pixelcut (remove-background), OpenAI (images/generations)
+# и Telegram Bot API, запускает приложение бота (photobot.create_app) и гонит
+# через вебхук синтетических пользователей: /start -> СТАРТ -> фото -> размещение
+# -> размер -> число вариантов -> сцена. Задача считается выполненной, когда бот
+# присылает «✅ Готово!».
+#
+#   python3 bench_load.py --users 20 --rate 2 --openai-latency 8 --variants 3
+#
+# Отчёт: время импорта бота и до готовности (/ready), p50/p95/p99 времени задачи,
+# задач в минуту, задержка event loop, пик RSS.
+# С --max-loop-lag код возврата 1, если event loop блокировался дольше порога —
+# так ловятся синхронные вызовы в асинхронном коде.
+
+import argparse
+import asyncio
+import base64
+import io
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import web
+
+BENCH_TOKEN = "123456:bench-token"
+DONE_TEXT = "✅ Готово!"
+FAIL_PREFIX = "Что-то пошло не так"
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+class FakeServices:
+    """Заглушки Pixelcut, OpenAI и Telegram Bot API в одном aiohttp-приложении."""
+
+    def __init__(self, args):
+        self.args = args
+        self.cutout = b""
+        self.backgrounds = {}  # size -> base64 PNG
+        self.photo = b""
+
+        self.message_ids = itertools.count(1000)
+        self.done_at: dict[int, float] = {}
+        self.done_events: dict[int, asyncio.Event] = {}
+        self.errors: dict[int, str] = {}
+        self.chat_requests: dict[int, list[float]] = {}
+        self.calls: dict[str, int] = {}
+
+    def count(self, name: str):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def prepare(self):
+        """Картинки заглушек. Вызывается после замера готовности бота: bench_compose
+        импортирует imaging (PIL/numpy/cv2), и иначе import_s/ready_s не измеряли бы
+        ленивую загрузку."""
+        from bench_compose import make_background, make_subject
+
+        self.cutout = make_subject()
+        # Фоны кодируем заранее: заглушка живёт в том же event loop и не должна портить замер задержки
+        sizes = [self.args.openai_size] if self.args.openai_size else ["1024x1024", "1024x1792", "1792x1024"]
+        for size in sizes:
+            w, h = map(int, size.split("x"))
+            buf = io.BytesIO()
+            make_background((w, h)).save(buf, format="PNG", compress_level=1)
+            self.backgrounds[size] = base64.b64encode(buf.getvalue()).decode()
+        buf = io.BytesIO()
+        make_background((self.args.photo_size, self.args.photo_size * 3 // 4)).save(buf, format="JPEG", quality=90)
+        self.photo = buf.getvalue()
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/pixelcut/remove-background", self.pixelcut)
+        app.router.add_post("/openai/v1/images/generations", self.openai)
+        app.router.add_post(f"/telegram/bot{BENCH_TOKEN}/{{method}}", self.telegram)
+        app.router.add_get(f"/telegram/file/bot{BENCH_TOKEN}/{{path:.+}}", self.telegram_file)
+        return app
+
+    async def pixelcut(self, request: web.Request):
+        await request.read()
+        self.count("pixelcut")
+        await asyncio.sleep(self.args.pixelcut_latency)
+        return web.Response(body=self.cutout, content_type="image/png")
+
+    async def openai(self, request: web.Request):
+        payload = await request.json()
+        self.count("openai")
+        await asyncio.sleep(self.args.openai_latency * random.uniform(0.8, 1.2))
+        size = self.args.openai_size or payload["size"]
+        return web.json_response({"created": int(time.time()), "data": [{"b64_json": self.backgrounds[size]}]})
+
+    def message(self, chat_id: int, **extra) -> dict:
+        return {"message_id": next(self.message_ids), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, **extra}
+
+    async def telegram(self, request: web.Request):
+        method = request.match_info["method"].lower()
+        self.count(f"telegram_{method}")
+        if request.content_type == "multipart/form-data":
+            form = await request.post()
+            data = {k: v for k, v in form.items() if isinstance(v, str)}
+        else:
+            data = dict(await request.post()) if request.can_read_body else {}
+        chat_id = int(data.get("chat_id", 0))
+
+        if chat_id and self.args.tg_chat_limit and self.flooded(chat_id):
+            self.count("telegram_429")
+            return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                      "parameters": {"retry_after": 1}})
+
+        if method in ("setwebhook", "deletewebhook", "deletemessage"):
+            result = True
+        elif method == "getwebhookinfo":
+            result = {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        elif method == "getfile":
+            result = {"file_id": data["file_id"], "file_unique_id": data["file_id"],
+                      "file_size": len(self.photo), "file_path": "photos/bench.jpg"}
+        elif method in ("sendmessage", "editmessagetext"):
+            text = data.get("text", "")
+            if method == "sendmessage" and (text == DONE_TEXT or text.startswith(FAIL_PREFIX)):
+                if text != DONE_TEXT:
+                    self.errors[chat_id] = text
+                self.done_at[chat_id] = time.perf_counter()
+                self.done_events.setdefault(chat_id, asyncio.Event()).set()
+            result = self.message(chat_id, text=text)
+        elif method == "senddocument":
+            result = self.message(chat_id, document={"file_id": "doc", "file_unique_id": "doc"})
+        elif method == "sendmediagroup":
+            media = json.loads(data.get("media", "[]"))
+            result = [self.message(chat_id, document={"file_id": "doc", "file_unique_id": "doc"}) for _ in media]
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def flooded(self, chat_id: int) -> bool:
+        """Flood control как у Telegram: не больше tg_chat_limit запросов в секунду на чат."""
+        now = time.monotonic()
+        recent = [t for t in self.chat_requests.get(chat_id, []) if now - t < 1]
+        if len(recent) >= self.args.tg_chat_limit:
+            self.chat_requests[chat_id] = recent
+            return True
+        recent.append(now)
+        self.chat_requests[chat_id] = recent
+        return False
+
+    async def telegram_file(self, request: web.Request):
+        self.count("telegram_download")
+        return web.Response(body=self.photo, content_type="image/jpeg")
+
+
+class LoopLagMonitor:
+    """Насколько event loop опаздывает с пробуждением: признак блокирующих вызовов."""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.samples: list[float] = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            t0 = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - t0 - self.interval))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        self._task.cancel()
+
+
+class SyntheticUser:
+    def __init__(self, chat_id: int, webhook_url: str, session: aiohttp.ClientSession, args, photo_id: str):
+        self.chat_id = chat_id
+        self.webhook_url = webhook_url
+        self.session = session
+        self.args = args
+        self.photo_id = photo_id
+        self.update_ids = itertools.count(chat_id * 100)
+
+    def update(self, **message) -> dict:
+        user = {"id": self.chat_id, "is_bot": False, "first_name": "Bench"}
+        return {"update_id": next(self.update_ids), "message": {
+            "message_id": next(self.update_ids), "date": int(time.time()),
+            "chat": {"id": self.chat_id, "type": "private"}, "from": user, **message}}
+
+    async def send(self, **message):
+        async with self.session.post(self.webhook_url, json=self.update(**message)) as resp:
+            if resp.status != 200:
+                raise RuntimeError(f"вебхук вернул {resp.status}: {await resp.text()}")
+
+    async def run(self) -> float:
+        """Пройти диалог; возвращает время от выбора сцены до «Готово»."""
+        from photobot import PRESETS, Placement
+        await self.send(text="/start", entities=[{"type": "bot_command", "offset": 0, "length": 6}])
+        await self.send(text="СТАРТ")
+        await self.send(photo=[{"file_id": self.photo_id, "file_unique_id": self.photo_id,
+                                "width": self.args.photo_size, "height": self.args.photo_size * 3 // 4}])
+        await self.send(text=Placement.STUDIO.value if self.args.placement == "studio" else Placement.ON_BODY.value)
+        await self.send(text=self.args.aspect)
+        await self.send(text=str(self.args.variants))
+        t0 = time.perf_counter()
+        await self.send(text=random.choice(PRESETS))
+        return t0
+
+
+async def run_bench(args) -> dict:
+    tmp = tempfile.mkdtemp(prefix="photobot-bench-")
+    try:
+        return await _run_bench(args, tmp)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+async def _run_bench(args, tmp: str) -> dict:
+    fake = FakeServices(args)
+    fake_runner = web.AppRunner(fake.app())
+    await fake_runner.setup()
+    await web.TCPSite(fake_runner, "127.0.0.1", args.fake_port).start()
+    fake_base = f"http://127.0.0.1:{args.fake_port}"
+
+    # Окружение бота — до импорта photobot: конфигурация читается при импорте
+    bot_port = args.bot_port
+    env = {
+        "BOT_TOKEN": BENCH_TOKEN,
+        "OPENAI_API_KEY": "bench",
+        "PIXELCUT_API_KEY": "bench",
+        "WEBHOOK_BASE_URL": f"http://127.0.0.1:{bot_port}",
+        "OPENAI_API_BASE": f"{fake_base}/openai/v1",
+        "PIXELCUT_API_URL": f"{fake_base}/pixelcut/remove-background",
+        "TELEGRAM_API_SERVER": f"{fake_base}/telegram",
+        "CUTOUT_BACKEND": "pixelcut",
+        "JOB_QUEUE_URL": f"sqlite:///{tmp}/jobs.sqlite3",
+        "FSM_STORAGE_URL": "",
+        "CUTOUT_CACHE_DIR": f"{tmp}/cutouts",
+        "BG_POOL_DIR": f"{tmp}/backgrounds",
+        "PROMPTS_FILE": f"{tmp}/prompts_cheatsheet.md",
+        "JOB_POLL_INTERVAL": "0.05",
+        # Лимиты бота на исходящие запросы: по умолчанию высокие, чтобы задержка
+        # мерила конвейер, а не троттлинг (--tg-chat-rate 1 — как в проде)
+        "TG_CHAT_RATE": str(args.tg_chat_rate),
+        "TG_GLOBAL_RATE": str(args.tg_global_rate),
+    }
+    # Перезаписываем, а не setdefault: настоящий BOT_TOKEN или DATABASE_URL из окружения
+    # разработчика увели бы бота мимо заглушек
+    os.environ.update(env)
+    t_import = time.perf_counter()
+    import photobot
+    import_s = time.perf_counter() - t_import
+
+    runner = web.AppRunner(photobot.create_app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", bot_port).start()
+    webhook_url = f"http://127.0.0.1:{bot_port}{photobot.WEBHOOK_PATH}"
+
+    # Пользователей пускаем, когда бот прогрелся — как балансировщик Railway
+    async with aiohttp.ClientSession() as session:
+        while True:
+            async with session.get(f"http://127.0.0.1:{bot_port}/ready") as resp:
+                if resp.status == 200:
+                    break
+            await asyncio.sleep(0.05)
+    ready_s = time.perf_counter() - t_import
+    fake.prepare()
+
+    lag = LoopLagMonitor()
+    lag.start()
+    latencies: list[float] = []
+    failures = 0
+
+    async def one_user(i: int, session: aiohttp.ClientSession):
+        nonlocal failures
+        chat_id = 10_000 + i
+        photo_id = "bench-photo" if args.same_photo else f"bench-photo-{i}"
+        user = SyntheticUser(chat_id, webhook_url, session, args, photo_id)
+        event = fake.done_events.setdefault(chat_id, asyncio.Event())
+        try:
+            t0 = await user.run()
+            await asyncio.wait_for(event.wait(), timeout=args.timeout)
+            if chat_id in fake.errors:
+                raise RuntimeError(fake.errors[chat_id])
+            latencies.append(fake.done_at[chat_id] - t0)
+        except Exception as e:
+            failures += 1
+            logging.error(f"Пользователь {chat_id}: {e!r}")
+
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        tasks = []
+        for i in range(args.users):
+            tasks.append(asyncio.create_task(one_user(i, session)))
+            await asyncio.sleep(1 / args.rate)
+        await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    lag.stop()
+
+    await runner.cleanup()
+    await fake_runner.cleanup()
+
+    rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return {
+        "import_s": round(import_s, 2),
+        "ready_s": round(ready_s, 2),
+        "users": args.users,
+        "completed": len(latencies),
+        "failed": failures,
+        "elapsed_s": round(elapsed, 2),
+        "jobs_per_min": round(len(latencies) / elapsed * 60, 2) if elapsed else 0.0,
+        "latency_p50_s": round(percentile(latencies, 50), 2),
+        "latency_p95_s": round(percentile(latencies, 95), 2),
+        "latency_p99_s": round(percentile(latencies, 99), 2),
+        "loop_lag_p99_ms": round(percentile(lag.samples, 99) * 1000, 1),
+        "loop_lag_max_ms": round(max(lag.samples, default=0.0) * 1000, 1),
+        "loop_lag_mean_ms": round(statistics.fmean(lag.samples) * 1000, 1) if lag.samples else 0.0,
+        "peak_rss_mb": round(rss_kb / 1024, 1),
+        "peak_rss_children_mb": round(children_kb / 1024, 1),
+        "calls": fake.calls,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота на локальных заглушках")
+    parser.add_argument("--users", type=int, default=10, help="сколько пользователей (задач) прогнать")
+    parser.add_argument("--rate", type=float, default=1.0, help="новых пользователей в секунду")
+    parser.add_argument("--variants", type=int, default=2, choices=range(1, 6))
+    parser.add_argument("--placement", choices=("studio", "on_body"), default="studio")
+    parser.add_argument("--aspect", default="1:1", choices=("1:1", "4:5", "3:4", "16:9", "9:16"))
+    parser.add_argument("--openai-latency", type=float, default=2.0, help="секунды на генерацию фона")
+    parser.add_argument("--openai-size", default="", help="размер возвращаемого фона, например 1024x1024 (по умолчанию — запрошенный)")
+    parser.add_argument("--pixelcut-latency", type=float, default=1.0, help="секунды на удаление фона")
+    parser.add_argument("--photo-size", type=int, default=2048, help="длинная сторона исходного фото")
+    parser.add_argument("--tg-chat-limit", type=int, default=0, help="отвечать 429, если чату шлют больше N запросов в секунду (0 — без лимита)")
+    parser.add_argument("--tg-chat-rate", type=float, default=100, help="лимит бота: сообщений в секунду на чат (TG_CHAT_RATE)")
+    parser.add_argument("--tg-global-rate", type=float, default=1000, help="лимит бота: сообщений в секунду всего (TG_GLOBAL_RATE)")
+    parser.add_argument("--same-photo", action="store_true", help="все присылают одно фото (проверка кэша вырезок)")
+    parser.add_argument("--timeout", type=float, default=600, help="предел ожидания одной задачи, секунды")
+    parser.add_argument("--fake-port", type=int, default=18081)
+    parser.add_argument("--bot-port", type=int, default=18080)
+    parser.add_argument("--max-loop-lag", type=float, default=0, help="порог задержки event loop, мс (0 — не проверять)")
+    parser.add_argument("--json", action="store_true", help="отчёт одной строкой JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="[%(asctime)s] %(levelname)s: %(message)s")
+    report = asyncio.run(run_bench(args))
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False))
+    else:
+        for key, value in report.items():
+            print(f"{key:>22}: {value}")
+
+    if report["failed"] or (args.max_loop_lag and report["loop_lag_max_ms"] > args.max_loop_lag):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+# bg_pool.py — библиотека заранее сгенерированных фонов для пресетов.
+#
+# Фоны хранятся на диске в каталоге на каждый ключ (промпт, размер). Запрос по
+# пресету забирает готовый фон из пула, а фоновая задача догенерирует его до
+# нужной глубины, так что пользователь не ждёт DALL-E.
+#
+# Каталог общий для всех процессов (веб, воркеры), поэтому состояние — только на диске:
+#   <key>/spec.json              — промпт и размер ключа (ключ запрошен или предзаполняется)
+#   <key>/<id>.<uses>.png        — фон, выданный uses раз
+#   <key>/<id>.<uses>.<tok>.claim — фон, который прямо сейчас забирает один из процессов
+# Забор — атомарный rename в .claim: один файл достаётся ровно одному процессу.
+# Догенерирует только процесс, держащий flock на .refill.lock; остальные лишь забирают.
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+from pathlib import Path
+from typing import Awaitable, Callable, Iterable, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокировки нет, догенерирует каждый процесс
+    fcntl = None
+
+# Забор или запись, не завершённые за это время (процесс упал), считаются потерянными
+_STALE_CLAIM = 60
+
+
+class BackgroundPool:
+    def __init__(self, directory: Path, depth: int, max_uses: int, ttl: float,
+                 generate: Callable[[str, str], Awaitable[bytes]], scan_interval: float = 30):
+        self.directory = directory
+        self.depth = depth
+        self.max_uses = max_uses
+        self.ttl = ttl
+        self.generate = generate
+        self.scan_interval = scan_interval
+
+        self._lock_fd: Optional[int] = None
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._stats = {"keys": 0, "backgrounds": 0}
+
+    @staticmethod
+    def key(prompt: str, size: str) -> str:
+        return hashlib.sha256(f"{size}\0{prompt}".encode()).hexdigest()[:32]
+
+    # ---- диск (вызывается в потоках) ----
+
+    def _register(self, prompt: str, size: str) -> Path:
+        """Каталог ключа со spec.json — по нему процесс-догенератор узнаёт, что ключ нужен."""
+        key_dir = self.directory / self.key(prompt, size)
+        spec = key_dir / "spec.json"
+        if not spec.exists():
+            key_dir.mkdir(parents=True, exist_ok=True)
+            tmp = key_dir / f"spec.{uuid.uuid4().hex}.tmp"
+            tmp.write_text(json.dumps({"prompt": prompt, "size": size}, ensure_ascii=False), encoding="utf-8")
+            tmp.replace(spec)
+        return key_dir
+
+    def _available(self, key_dir: Path) -> list[tuple[int, Path]]:
+        """Живые фоны ключа (uses, путь) — реже выданные первыми; просроченное удаляется."""
+        now = time.time()
+        result = []
+        for path in key_dir.iterdir():
+            try:
+                age = now - path.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            if path.suffix in (".claim", ".tmp"):
+                if age > _STALE_CLAIM:
+                    path.unlink(missing_ok=True)
+            elif path.suffix == ".png":
+                if age > self.ttl:
+                    path.unlink(missing_ok=True)
+                else:
+                    parts = path.stem.split(".")
+                    result.append((int(parts[1]) if len(parts) > 1 else 0, path))
+        return sorted(result)
+
+    def _claim(self, prompt: str, size: str) -> Optional[bytes]:
+        key_dir = self.directory / self.key(prompt, size)
+        for uses, path in self._available(key_dir) if key_dir.is_dir() else ():
+            file_id = path.stem.split(".")[0]
+            claimed = key_dir / f"{file_id}.{uses}.{uuid.uuid4().hex[:8]}.claim"
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                continue  # забрал другой процесс
+            data = claimed.read_bytes()
+            if uses + 1 < self.max_uses:
+                # rename сохраняет mtime: TTL отсчитывается от генерации, а не от выдачи
+                os.replace(claimed, key_dir / f"{file_id}.{uses + 1}.png")
+            else:
+                claimed.unlink(missing_ok=True)
+            return data
+        self._register(prompt, size)
+        return None
+
+    def _write(self, key_dir: Path, data: bytes):
+        tmp = key_dir / f"{uuid.uuid4().hex}.tmp"
+        tmp.write_bytes(data)
+        tmp.replace(key_dir / f"{tmp.stem}.0.png")
+
+    def _missing(self) -> list[tuple[Path, str, str, int]]:
+        """Ключи, где фонов меньше depth: (каталог, промпт, размер, сколько не хватает)."""
+        missing, keys, backgrounds = [], 0, 0
+        for spec in self.directory.glob("*/spec.json"):
+            try:
+                info = json.loads(spec.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                continue
+            count = len(self._available(spec.parent))
+            keys += 1
+            backgrounds += count
+            if count < self.depth:
+                missing.append((spec.parent, info["prompt"], info["size"], self.depth - count))
+        self._stats = {"keys": keys, "backgrounds": backgrounds}
+        return missing
+
+    def _try_lock(self) -> bool:
+        if self._lock_fd is not None or fcntl is None:
+            return True
+        fd = os.open(self.directory / ".refill.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    # ---- жизненный цикл ----
+
+    async def start(self, prefill: Iterable[tuple[str, str]] = ()):
+        """prefill — ключи, которые заполняются сразу, ещё до первого запроса."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for prompt, size in prefill:
+            await asyncio.to_thread(self._register, prompt, size)
+        self._task = asyncio.create_task(self._refill_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)  # закрытие снимает flock — догенерацию подхватит другой процесс
+            self._lock_fd = None
+
+    async def _refill_loop(self):
+        while True:
+            try:
+                if await asyncio.to_thread(self._try_lock):
+                    await self._refill()
+                else:
+                    await asyncio.to_thread(self._missing)  # только для stats()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception("Пул фонов: ошибка догенерации")
+            # Забор в другом процессе сюда не сигналит — поэтому ещё и периодический обход.
+            # Не wait_for: в Python 3.10 он теряет отмену, если событие уже установлено,
+            # и close() зависает навсегда
+            waiter = asyncio.ensure_future(self._wake.wait())
+            try:
+                await asyncio.wait({waiter}, timeout=self.scan_interval)
+            finally:
+                waiter.cancel()
+            self._wake.clear()
+
+    async def _refill(self):
+        # По одному фону за раз, чтобы не отнимать лимит OpenAI у живых запросов
+        for key_dir, prompt, size, count in await asyncio.to_thread(self._missing):
+            for _ in range(count):
+                try:
+                    data = await self.generate(prompt, size)
+                except Exception as e:
+                    logging.warning(f"Пул фонов: не удалось догенерировать фон ({size}): {e}")
+                    break
+                await asyncio.to_thread(self._write, key_dir, data)
+                self._stats["backgrounds"] += 1
+
+    async def take(self, prompt: str, size: str) -> Optional[bytes]:
+        """Готовый фон из пула или None, если пул по этому ключу пуст."""
+        try:
+            data = await asyncio.to_thread(self._claim, prompt, size)
+        except OSError as e:
+            logging.warning(f"Пул фонов: не удалось прочитать фон: {e}")
+            data = None
+        if data is not None:
+            self._stats["backgrounds"] = max(0, self._stats["backgrounds"] - 1)
+        self._wake.set()
+        return data
+
+    def stats(self) -> dict:
+        return {**self._stats, "refiller": int(self._lock_fd is not None)}
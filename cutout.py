@@ -0,0 +1,164 @@
+# cutout.py — бэкенды удаления фона (вырезания объекта).
+#
+# Все бэкенды принимают RGB JPEG и возвращают PNG с прозрачным фоном.
+
+import asyncio
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+import aiohttp
+
+from job_queue import PermanentError
+from metrics import API_RESPONSES
+
+# Ответы API, которые повтор не исправит: неверный запрос, ключ, доступ.
+# 408/409/429 — временные, их повторяем
+TRANSIENT_CLIENT_ERRORS = (408, 409, 429)
+
+
+def api_error(status: int, message: str) -> RuntimeError:
+    """Исключение для неуспешного ответа API: PermanentError для 4xx (кроме временных)."""
+    permanent = 400 <= status < 500 and status not in TRANSIENT_CLIENT_ERRORS
+    return (PermanentError if permanent else RuntimeError)(message)
+
+
+class CutoutBackend:
+    """Базовый интерфейс бэкенда удаления фона."""
+    name = "base"
+
+    async def start(self):
+        """Подготовка ресурсов (вызывается один раз при прогреве после запуска)."""
+
+    async def close(self):
+        """Освобождение ресурсов (вызывается в on_shutdown)."""
+
+    async def remove(self, image_bytes: bytes) -> bytes:
+        raise NotImplementedError
+
+
+class PixelcutBackend(CutoutBackend):
+    """Удаление фона через API Pixelcut."""
+    name = "pixelcut"
+
+    def __init__(self, api_key: str, get_session: Callable[[], aiohttp.ClientSession],
+                 endpoint: str = "https://api.pixelcut.ai/v1/remove-background"):
+        self.api_key = api_key
+        self.get_session = get_session
+        self.endpoint = endpoint
+
+    async def remove(self, image_bytes: bytes) -> bytes:
+        headers = {"X-API-Key": self.api_key}
+
+        data = aiohttp.FormData()
+        data.add_field('image',
+                       image_bytes,
+                       filename='input.jpg',
+                       content_type='image/jpeg')
+
+        session = self.get_session()
+        try:
+            async with session.post(self.endpoint, headers=headers, data=data) as response:
+                API_RESPONSES.labels("pixelcut", str(response.status)).inc()
+                if response.status == 200:
+                    return await response.read()
+                elif response.status == 401:
+                    raise PermanentError("Ошибка авторизации (401) в Pixelcut. Проверьте API-ключ.")
+                else:
+                    detail = await response.text()
+                    raise api_error(response.status, f"Ошибка API Pixelcut (статус {response.status}): {detail}")
+        except aiohttp.ClientError as e:
+            API_RESPONSES.labels("pixelcut", "error").inc()
+            raise RuntimeError(f"Не удалось подключиться к сервису удаления фона: {e}")
+
+
+class RembgBackend(CutoutBackend):
+    """Локальное удаление фона моделью rembg (onnxruntime).
+
+    ONNX-сессия загружается один раз в start() и переиспользуется; инференс
+    идёт в отдельном пуле потоков (onnxruntime отпускает GIL).
+    """
+    name = "rembg"
+
+    def __init__(self, model: str = "u2net", threads: int = 0, workers: int = 1):
+        self.model = model
+        self.threads = threads
+        self.workers = workers
+        self._session = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _load_session(self):
+        # Импорт здесь: rembg/onnxruntime тяжёлые и нужны только этому бэкенду
+        import onnxruntime as ort
+        from rembg.sessions import sessions_class
+
+        session_class = next((sc for sc in sessions_class if sc.name() == self.model), None)
+        if session_class is None:
+            known = ", ".join(sorted(sc.name() for sc in sessions_class))
+            raise RuntimeError(f"Неизвестная модель rembg: REMBG_MODEL={self.model} (доступны: {known})")
+        sess_opts = ort.SessionOptions()
+        if self.threads > 0:
+            sess_opts.intra_op_num_threads = self.threads
+            sess_opts.inter_op_num_threads = 1
+        return session_class(self.model, sess_opts)
+
+    def _remove_sync(self, image_bytes: bytes) -> bytes:
+        from rembg import remove
+        return remove(image_bytes, session=self._session)
+
+    def _warm_up_sync(self):
+        # Первый инференс onnxruntime в разы медленнее (выделение памяти, выбор ядер) — платим при старте
+        from PIL import Image
+        buf = io.BytesIO()
+        Image.new("RGB", (64, 64), (255, 255, 255)).save(buf, format="JPEG")
+        self._remove_sync(buf.getvalue())
+
+    async def start(self):
+        if self._session is not None:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="rembg")
+        loop = asyncio.get_running_loop()
+        self._session = await loop.run_in_executor(self._executor, self._load_session)
+        await loop.run_in_executor(self._executor, self._warm_up_sync)
+        logging.info(f"✔ Модель rembg '{self.model}' загружена")
+
+    async def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+        self._session = None
+
+    async def remove(self, image_bytes: bytes) -> bytes:
+        if self._session is None:
+            raise RuntimeError("Модель rembg не загружена (прогрев ещё не выполнен?)")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._remove_sync, image_bytes)
+
+
+class FallbackBackend(CutoutBackend):
+    """Сначала основной бэкенд, при ошибке — запасной."""
+
+    def __init__(self, primary: CutoutBackend, fallback: CutoutBackend):
+        self.primary = primary
+        self.fallback = fallback
+        self.name = f"{primary.name}+{fallback.name}"
+
+    async def start(self):
+        try:
+            await self.primary.start()
+        except Exception:
+            # Не смогли загрузить локальную модель — работаем только через запасной
+            logging.exception(f"Бэкенд {self.primary.name} не запустился, использую {self.fallback.name}")
+        await self.fallback.start()
+
+    async def close(self):
+        await self.primary.close()
+        await self.fallback.close()
+
+    async def remove(self, image_bytes: bytes) -> bytes:
+        try:
+            return await self.primary.remove(image_bytes)
+        except Exception as e:
+            logging.warning(f"Бэкенд {self.primary.name} не справился ({e}), пробую {self.fallback.name}")
+            return await self.fallback.remove(image_bytes)
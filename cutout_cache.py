@@ -0,0 +1,158 @@
+# cutout_cache.py — кэш вырезанных объектов (PNG без фона).
+#
+# Ключ — хэш исходного изображения (или file_unique_id из Telegram), так что
+# повторная генерация с тем же фото не вызывает удаление фона повторно.
+# Два уровня: LRU в памяти и каталог на диске с ограничением размера и TTL.
+
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+
+def cache_key(*parts) -> str:
+    """Ключ кэша из частей (bytes хэшируются целиком, остальное — как строка)."""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part if isinstance(part, (bytes, bytearray)) else str(part).encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class CutoutCache:
+    def __init__(self, directory: Optional[Path], mem_max_bytes: int,
+                 disk_max_bytes: int, ttl: float):
+        self.directory = directory
+        self.mem_max_bytes = mem_max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self.ttl = ttl
+
+        self._mem: OrderedDict[str, bytes] = OrderedDict()
+        self._mem_bytes = 0
+        self._disk_bytes = 0
+        self._disk_lock = asyncio.Lock()
+
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits_memory + self.hits_disk + self.misses
+        hits = self.hits_memory + self.hits_disk
+        return {
+            "hits_memory": self.hits_memory,
+            "hits_disk": self.hits_disk,
+            "misses": self.misses,
+            "hit_ratio": round(hits / lookups, 3) if lookups else 0.0,
+            "memory_bytes": self._mem_bytes,
+            "disk_bytes": self._disk_bytes,
+        }
+
+    # ---- память ----
+
+    def _mem_get(self, key: str) -> Optional[bytes]:
+        data = self._mem.get(key)
+        if data is not None:
+            self._mem.move_to_end(key)
+        return data
+
+    def _mem_put(self, key: str, data: bytes):
+        if len(data) > self.mem_max_bytes:
+            return
+        old = self._mem.pop(key, None)
+        if old is not None:
+            self._mem_bytes -= len(old)
+        self._mem[key] = data
+        self._mem_bytes += len(data)
+        while self._mem_bytes > self.mem_max_bytes:
+            _, evicted = self._mem.popitem(last=False)
+            self._mem_bytes -= len(evicted)
+
+    # ---- диск ----
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.png"
+
+    def _disk_get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            if time.time() - path.stat().st_mtime > self.ttl:
+                return None
+            return path.read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def _disk_put(self, key: str, data: bytes) -> int:
+        """Записывает файл; возвращает, на сколько изменился размер кэша на диске."""
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            old_size = path.stat().st_size  # перезапись того же ключа — считаем только разницу
+        except FileNotFoundError:
+            old_size = 0
+        tmp = path.with_suffix(".tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)  # атомарно: читатели не увидят недописанный файл
+        return len(data) - old_size
+
+    def _disk_sweep(self) -> int:
+        """Удаляет просроченные файлы и самые старые сверх лимита; возвращает итоговый размер."""
+        now = time.time()
+        files = []
+        for path in self.directory.glob("*/*.png"):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            if now - st.st_mtime > self.ttl:
+                path.unlink(missing_ok=True)
+            else:
+                files.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.disk_max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+        return total
+
+    async def start(self):
+        if self.directory is None:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        async with self._disk_lock:
+            self._disk_bytes = await asyncio.to_thread(self._disk_sweep)
+
+    # ---- публичный интерфейс ----
+
+    async def get(self, key: str) -> Optional[bytes]:
+        data = self._mem_get(key)
+        if data is not None:
+            self.hits_memory += 1
+            return data
+        if self.directory is not None:
+            data = await asyncio.to_thread(self._disk_get, key)
+            if data is not None:
+                self.hits_disk += 1
+                self._mem_put(key, data)
+                return data
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, data: bytes):
+        self._mem_put(key, data)
+        if self.directory is None:
+            return
+        try:
+            delta = await asyncio.to_thread(self._disk_put, key, data)
+            async with self._disk_lock:
+                self._disk_bytes += delta
+                if self._disk_bytes > self.disk_max_bytes:
+                    self._disk_bytes = await asyncio.to_thread(self._disk_sweep)
+        except OSError as e:
+            # Диск — лишь второй уровень кэша, ошибка записи не должна ронять генерацию
+            logging.warning(f"Не удалось сохранить вырезку в кэш на диске: {e}")
@@ -0,0 +1,90 @@
+# db.py — минимальная обёртка над Postgres (psycopg2) и SQLite.
+#
+# Запросы пишутся с плейсхолдерами "?" и переводятся в "%s" для Postgres.
+# Драйверы синхронные, поэтому все операции выполняются в потоках
+# (asyncio.to_thread) и не блокируют event loop.
+# Пул соединений Postgres создаётся в open() (или при первом запросе), а не в
+# конструкторе: ThreadedConnectionPool сразу подключается к БД, а объекты Database
+# создаются при импорте бота, до того как он займёт порт.
+
+import asyncio
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, Callable
+
+
+class Database:
+    def __init__(self, url: str, pool_size: int = 5):
+        self.url = url
+        if url.startswith(("postgres://", "postgresql://")):
+            self.dialect = "postgres"
+            self._pool_size = pool_size
+            self._pool = None
+            self._pool_lock = threading.Lock()
+        elif url.startswith("sqlite:///"):
+            self.dialect = "sqlite"
+            self._path = url[len("sqlite:///"):]
+            Path(self._path).parent.mkdir(parents=True, exist_ok=True)
+            self._local = threading.local()
+        else:
+            raise ValueError(f"Неподдерживаемый адрес БД: {url.split(':', 1)[0]}")
+
+    @property
+    def serial_pk(self) -> str:
+        return "BIGSERIAL PRIMARY KEY" if self.dialect == "postgres" else "INTEGER PRIMARY KEY AUTOINCREMENT"
+
+    def sql(self, query: str) -> str:
+        return query.replace("?", "%s") if self.dialect == "postgres" else query
+
+    def _pg_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                import psycopg2.pool
+                self._pool = psycopg2.pool.ThreadedConnectionPool(1, self._pool_size, dsn=self.url)
+            return self._pool
+
+    async def open(self):
+        """Подключиться заранее (в потоке), чтобы ошибка адреса или доступа была видна при старте."""
+        if self.dialect == "postgres":
+            await asyncio.to_thread(self._pg_pool)
+
+    def _sqlite_conn(self) -> sqlite3.Connection:
+        # Одно соединение на поток; транзакции открываем сами (BEGIN IMMEDIATE),
+        # чтобы выборка и обновление в одной операции были атомарны между процессами.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def run_sync(self, fn: Callable[[Any], Any]) -> Any:
+        """Выполнить fn(cursor) в одной транзакции."""
+        if self.dialect == "postgres":
+            pool = self._pg_pool()
+            conn = pool.getconn()
+            try:
+                with conn:  # commit / rollback
+                    with conn.cursor() as cur:
+                        return fn(cur)
+            finally:
+                pool.putconn(conn)
+        conn = self._sqlite_conn()
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(cur)
+        except BaseException:
+            cur.execute("ROLLBACK")
+            raise
+        cur.execute("COMMIT")
+        return result
+
+    async def run(self, fn: Callable[[Any], Any]) -> Any:
+        return await asyncio.to_thread(self.run_sync, fn)
+
+    def close(self):
+        if self.dialect == "postgres" and self._pool is not None:
+            self._pool.closeall()
+            self._pool = None
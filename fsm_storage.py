@@ -0,0 +1,174 @@
+# fsm_storage.py — хранилище FSM aiogram в БД (Postgres или SQLite).
+#
+# Позволяет запускать несколько реплик вебхука и не терять диалоги при рестарте.
+# update_data/set_data копятся в памяти и пишутся пачкой: set_state сбрасывает
+# буфер своего ключа сразу (следующее сообщение пользователя может попасть на
+# другую реплику), остальное — фоновой задачей раз в flush_interval.
+# Сессии без активности дольше ttl считаются пустыми и удаляются.
+
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+
+from db import Database
+
+_UNSET = object()
+
+
+class SQLStorage(BaseStorage):
+    def __init__(self, db: Database, ttl: float, flush_interval: float = 0.2, purge_interval: float = 600):
+        self.db = db
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.purge_interval = purge_interval
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+
+        # key -> [state, data]; _UNSET — поле не менялось и берётся из БД
+        self._pending: Dict[str, list] = {}
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    async def setup(self):
+        def create(cur):
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS fsm_state (
+                    key TEXT PRIMARY KEY,
+                    state TEXT,
+                    data TEXT NOT NULL DEFAULT '{}',
+                    updated_at DOUBLE PRECISION NOT NULL
+                )""")
+            cur.execute("CREATE INDEX IF NOT EXISTS fsm_state_updated ON fsm_state (updated_at)")
+
+        await self.db.run(create)
+        if self._task is None:
+            self._task = asyncio.create_task(self._background())
+
+    # ---- чтение ----
+
+    async def _load(self, key: str) -> tuple[Optional[str], Dict[str, Any]]:
+        db = self.db
+
+        def select(cur):
+            cur.execute(db.sql("SELECT state, data FROM fsm_state WHERE key = ? AND updated_at >= ?"),
+                        (key, time.time() - self.ttl))
+            return cur.fetchone()
+
+        row = await db.run(select)
+        if row is None:
+            return None, {}
+        return row[0], json.loads(row[1])
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        k = self.key_builder.build(key)
+        pending = self._pending.get(k)
+        if pending is not None and pending[0] is not _UNSET:
+            return pending[0]
+        return (await self._load(k))[0]
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        k = self.key_builder.build(key)
+        pending = self._pending.get(k)
+        if pending is not None and pending[1] is not _UNSET:
+            return pending[1].copy()
+        return (await self._load(k))[1]
+
+    # ---- запись ----
+
+    def _buffer(self, key: str) -> list:
+        return self._pending.setdefault(key, [_UNSET, _UNSET])
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k = self.key_builder.build(key)
+        self._buffer(k)[0] = state.state if isinstance(state, State) else state
+        await self.flush(k)
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        self._buffer(self.key_builder.build(key))[1] = data.copy()
+
+    async def update_data(self, key: StorageKey, data: Dict[str, Any]) -> Dict[str, Any]:
+        current = await self.get_data(key)
+        current.update(data)
+        await self.set_data(key, current)
+        return current.copy()
+
+    async def flush(self, only_key: Optional[str] = None):
+        """Записать накопленные изменения одним пакетом (все или одного ключа)."""
+        async with self._flush_lock:
+            if only_key is not None:
+                entry = self._pending.pop(only_key, None)
+                batch = {only_key: entry} if entry is not None else {}
+            else:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return
+            try:
+                await self.db.run(lambda cur: self._write(cur, batch))
+            except Exception:
+                # Не теряем изменения: вернём в буфер те поля, что не перезаписаны новыми
+                for k, (state, data) in batch.items():
+                    entry = self._buffer(k)
+                    if entry[0] is _UNSET:
+                        entry[0] = state
+                    if entry[1] is _UNSET:
+                        entry[1] = data
+                raise
+
+    def _write(self, cur, batch: Dict[str, list]):
+        db = self.db
+        now = time.time()
+        full, only_state, only_data = [], [], []
+        for k, (state, data) in batch.items():
+            if state is not _UNSET and data is not _UNSET:
+                full.append((k, state, json.dumps(data, ensure_ascii=False), now))
+            elif state is not _UNSET:
+                only_state.append((k, state, now))
+            else:
+                only_data.append((k, json.dumps(data, ensure_ascii=False), now))
+        if full:
+            cur.executemany(db.sql(
+                "INSERT INTO fsm_state (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET state = excluded.state, data = excluded.data, "
+                "updated_at = excluded.updated_at"), full)
+        if only_state:
+            cur.executemany(db.sql(
+                "INSERT INTO fsm_state (key, state, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at"),
+                only_state)
+        if only_data:
+            cur.executemany(db.sql(
+                "INSERT INTO fsm_state (key, data, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at"),
+                only_data)
+
+    async def purge(self):
+        db = self.db
+        await db.run(lambda cur: cur.execute(db.sql("DELETE FROM fsm_state WHERE updated_at < ?"),
+                                             (time.time() - self.ttl,)))
+
+    async def _background(self):
+        last_purge = 0.0
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - last_purge > self.purge_interval:
+                    await self.purge()
+                    last_purge = time.monotonic()
+            except Exception:
+                logging.exception("Не удалось записать состояния FSM в БД")
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        self.db.close()
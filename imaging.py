@@ -0,0 +1,279 @@
+# imaging.py — CPU-тяжёлая обработка изображений.
+#
+# Функции модуля выполняются в пуле процессов (см. run_imaging в photobot.py),
+# поэтому принимают и возвращают только bytes/числа и не зависят от
+# переменных окружения и объектов бота.
+
+import io
+import time
+from pathlib import Path
+from typing import Optional, Union
+
+from PIL import ExifTags, Image, ImageOps
+import numpy as np
+import cv2
+
+
+def init_worker():
+    """Инициализация процесса пула: OpenCV не должен плодить свои потоки в каждом воркере."""
+    cv2.setNumThreads(1)
+
+
+def normalize_input(source: Union[bytes, Path], max_edge: int) -> bytes:
+    """Приведение исходника к RGB JPEG с длинной стороной не больше max_edge.
+
+    source — байты или путь к файлу: крупные загрузки лежат на диске, и PIL
+    читает из файла по мере декодирования, не держа его в памяти целиком.
+    JPEG декодируется сразу в уменьшенном масштабе (draft: 1/2, 1/4, 1/8 на этапе
+    DCT), остальные форматы — через reduce(); поворот по EXIF применяется.
+    Если исходник уже подходящий JPEG, он возвращается без перекодирования.
+    """
+    with Image.open(io.BytesIO(source) if isinstance(source, bytes) else source) as img:
+        return _normalize(img, source, max_edge)
+
+
+# Режимы, которые умеет Image.reduce; остальные сначала переводятся в RGB
+_REDUCE_MODES = ("L", "LA", "I", "F", "RGB", "RGBA", "CMYK", "YCbCr")
+
+
+def _normalize(img: Image.Image, source: Union[bytes, Path], max_edge: int) -> bytes:
+    orientation = img.getexif().get(ExifTags.Base.Orientation, 1)
+    w, h = img.size
+    long_edge = max(w, h)
+
+    if img.format == "JPEG" and img.mode == "RGB" and orientation == 1 and long_edge <= max_edge:
+        return source if isinstance(source, bytes) else source.read_bytes()
+
+    if long_edge > max_edge:
+        ratio = max_edge / long_edge
+        if img.format == "JPEG":
+            # Размер для draft — с сохранением пропорций, иначе масштаб выберется по короткой стороне
+            img.draft("RGB", (max(1, int(w * ratio)), max(1, int(h * ratio))))
+        else:
+            factor = int(1 / ratio)
+            if factor >= 2:
+                if img.mode not in _REDUCE_MODES:
+                    # reduce() не работает с палитрой, 1-битными и 16-битными изображениями
+                    img = img.convert("RGB")
+                img = img.reduce(factor)
+
+    img = ImageOps.exif_transpose(img)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    if max(img.size) > max_edge:
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=95)
+    return buf.getvalue()
+
+
+# Тень в студийной композиции: смещение, размытие и во сколько раз уменьшаем
+# маску перед размытием (результат визуально неотличим, а считается в разы быстрее)
+SHADOW_OFFSET = (8, 18)
+SHADOW_BLUR = 12
+SHADOW_DOWNSCALE = 4
+# Поле вокруг маски тени, в которое она растекается при размытии (~3 сигмы).
+# Вырезка обрезана по альфе, и без поля тень обрывалась бы жёсткой полосой
+SHADOW_PAD = 3 * SHADOW_BLUR
+
+
+def premultiplied_resize(rgba: np.ndarray, size: tuple[int, int]) -> np.ndarray:
+    """RGBA uint8 -> RGBA с предумноженным цветом нужного размера (w, h).
+
+    Предумножение до ресайза, как делает PIL для RGBA: иначе цвет прозрачных
+    пикселей вокруг объекта «затекает» в край.
+    """
+    alpha4 = cv2.cvtColor(rgba[:, :, 3], cv2.COLOR_GRAY2RGBA)
+    alpha4[:, :, 3] = 255
+    prem = cv2.multiply(rgba, alpha4, scale=1 / 255)
+    if size == (rgba.shape[1], rgba.shape[0]):
+        return prem
+    shrink = size[0] < rgba.shape[1]
+    return cv2.resize(prem, size, interpolation=cv2.INTER_AREA if shrink else cv2.INTER_LANCZOS4)
+
+
+def _shadow_alpha(alpha: np.ndarray) -> np.ndarray:
+    """Размытая маска тени (uint8) с полем SHADOW_PAD с каждой стороны.
+
+    Размываем уменьшенную маску и растягиваем обратно.
+    """
+    alpha = cv2.copyMakeBorder(alpha, SHADOW_PAD, SHADOW_PAD, SHADOW_PAD, SHADOW_PAD, cv2.BORDER_CONSTANT, value=0)
+    h, w = alpha.shape
+    sw, sh = max(1, w // SHADOW_DOWNSCALE), max(1, h // SHADOW_DOWNSCALE)
+    small = cv2.resize(alpha, (sw, sh), interpolation=cv2.INTER_AREA)
+    small = cv2.GaussianBlur(small, (0, 0), SHADOW_BLUR * sw / w, borderType=cv2.BORDER_REPLICATE)
+    return cv2.resize(small, (w, h), interpolation=cv2.INTER_LINEAR)
+
+
+def _clip(ox: int, oy: int, w: int, h: int, roi: tuple) -> Optional[tuple]:
+    """Пересечение прямоугольника (ox, oy, w, h) с ROI: срезы в координатах ROI и источника."""
+    x0, y0, x1, y1 = roi
+    cx0, cy0 = max(ox, x0), max(oy, y0)
+    cx1, cy1 = min(ox + w, x1), min(oy + h, y1)
+    if cx0 >= cx1 or cy0 >= cy1:
+        return None
+    return ((slice(cy0 - y0, cy1 - y0), slice(cx0 - x0, cx1 - x0)),
+            (slice(cy0 - oy, cy1 - oy), slice(cx0 - ox, cx1 - ox)))
+
+
+def blend_with_shadow(canvas: np.ndarray, prem: np.ndarray, x: int, y: int):
+    """Тень и объект (предумноженный RGBA) за один проход, на месте в canvas (RGB uint8).
+
+    Работаем только внутри ROI объекта с тенью:
+    out = фон * (1 - тень) * (1 - альфа) + предумноженный цвет.
+    """
+    h, w = prem.shape[:2]
+    dx, dy = SHADOW_OFFSET
+    H, W = canvas.shape[:2]
+    # Тень с полем размытия: сдвинута на SHADOW_OFFSET и шире объекта на SHADOW_PAD с каждой стороны
+    sx, sy = x + dx - SHADOW_PAD, y + dy - SHADOW_PAD
+    sw, sh = w + 2 * SHADOW_PAD, h + 2 * SHADOW_PAD
+    roi = (max(min(x, sx), 0), max(min(y, sy), 0), min(max(x + w, sx + sw), W), min(max(y + h, sy + sh), H))
+    if roi[0] >= roi[2] or roi[1] >= roi[3]:
+        return
+
+    # keep — какая доля фона остаётся (0..255)
+    keep = np.full((roi[3] - roi[1], roi[2] - roi[0]), 255, np.uint8)
+    shadow = _clip(sx, sy, sw, sh, roi)
+    if shadow is not None:
+        keep[shadow[0]] = 255 - _shadow_alpha(prem[:, :, 3])[shadow[1]]
+    body = _clip(x, y, w, h, roi)
+    if body is not None:
+        keep_body = keep[body[0]]
+        cv2.multiply(keep_body, 255 - prem[body[1]][:, :, 3], dst=keep_body, scale=1 / 255)
+
+    view = canvas[roi[1]:roi[3], roi[0]:roi[2]]
+    cv2.multiply(view, cv2.cvtColor(keep, cv2.COLOR_GRAY2RGB), dst=view, scale=1 / 255)
+    if body is not None:
+        view_body = view[body[0]]
+        cv2.add(view_body, np.ascontiguousarray(prem[body[1]][:, :, :3]), dst=view_body)
+
+
+def compose_subject_on_bg(subject_png: bytes, bg_img: Image.Image) -> Image.Image:
+    """Наложение объекта на фон с тенью."""
+    subj = np.asarray(Image.open(io.BytesIO(subject_png)).convert("RGBA"))
+
+    # Масштабирование
+    canvas_w, canvas_h = bg_img.size
+    target_h = int(canvas_h * 0.75)
+    scale = target_h / subj.shape[0]
+    prem = premultiplied_resize(subj, (max(1, int(subj.shape[1] * scale)), target_h))
+
+    # Композиция прямо в массиве фона, без лишних полноразмерных слоёв
+    canvas = np.array(bg_img if bg_img.mode == "RGB" else bg_img.convert("RGB"))
+    x = (canvas_w - prem.shape[1]) // 2
+    y = canvas_h - prem.shape[0] - int(canvas_h * 0.05)
+    blend_with_shadow(canvas, prem, x, y)
+    return Image.fromarray(canvas)
+
+
+# Запас вокруг объекта при бесшовном встраивании: уравнение Пуассона решаем
+# только в этом окне фона, а не на всём изображении
+SEAMLESS_PAD = 16
+
+
+def seamless_place(subject_png: bytes, back_img: Image.Image, scale_by_height: float, x_center: int, y_center: int) -> Image.Image:
+    """"Бесшовное" встраивание объекта в фон (для рук/тела)."""
+    fore = Image.open(io.BytesIO(subject_png)).convert("RGBA")
+    back = np.array(back_img if back_img.mode == "RGB" else back_img.convert("RGB"))
+    bh, bw = back.shape[:2]
+
+    # Высота — по реальному объекту (вырезка обрезана по альфе); объект должен влезть в фон
+    ratio = min(bh * scale_by_height / fore.height, (bw - 2) / fore.width, (bh - 2) / fore.height)
+    fore = fore.resize((max(1, int(fore.width * ratio)), max(1, int(fore.height * ratio))), Image.LANCZOS)
+
+    fore_np = np.asarray(fore)
+    mask = np.ascontiguousarray(fore_np[:, :, 3])
+    if not mask.any():
+        return Image.fromarray(back)
+    fh, fw = mask.shape
+
+    # Центр сдвигаем так, чтобы объект целиком попал на фон (иначе seamlessClone падает)
+    cx = min(max(x_center, fw // 2 + 1), bw - (fw - fw // 2) - 1)
+    cy = min(max(y_center, fh // 2 + 1), bh - (fh - fh // 2) - 1)
+
+    # Окно фона вокруг объекта; результат вставляем обратно на место
+    x0, y0 = max(0, cx - fw // 2 - SEAMLESS_PAD), max(0, cy - fh // 2 - SEAMLESS_PAD)
+    x1, y1 = min(bw, cx + (fw - fw // 2) + SEAMLESS_PAD), min(bh, cy + (fh - fh // 2) + SEAMLESS_PAD)
+    window = np.ascontiguousarray(back[y0:y1, x0:x1])
+
+    # seamlessClone не зависит от порядка каналов — работаем прямо в RGB
+    mixed = cv2.seamlessClone(np.ascontiguousarray(fore_np[:, :, :3]), window, mask,
+                              (cx - x0, cy - y0), cv2.NORMAL_CLONE)
+    back[y0:y1, x0:x1] = mixed
+    return Image.fromarray(back)
+
+
+def trim_transparent(subject_png: bytes, threshold: int = 8) -> bytes:
+    """Обрезка прозрачных полей вырезки по рамке альфа-канала.
+
+    Пиксели с альфой не больше threshold считаются пустыми (шум по краям кадра).
+    Если обрезать нечего, возвращаются исходные байты.
+    """
+    img = Image.open(io.BytesIO(subject_png))
+    if img.mode != "RGBA":
+        img = img.convert("RGBA")
+    bbox = img.getchannel("A").point(lambda v: 255 if v > threshold else 0).getbbox()
+    if bbox is None or bbox == (0, 0, img.width, img.height):
+        return subject_png
+    buf = io.BytesIO()
+    # Вырезка — промежуточный результат: быстрое сжатие важнее размера
+    img.crop(bbox).save(buf, format="PNG", compress_level=1)
+    return buf.getvalue()
+
+
+# ========= Точки входа для пула (bytes -> bytes) =========
+
+def encode_image(img: Image.Image, output: tuple[str, int, int]) -> bytes:
+    """Кодирование результата; output = (формат, качество JPEG/WebP, compress_level PNG)."""
+    fmt, quality, png_level = output
+    buf = io.BytesIO()
+    if fmt == "png":
+        img.save(buf, format="PNG", compress_level=png_level)
+    elif fmt == "jpeg":
+        # subsampling=0 (4:4:4) — без размытия цветных краёв товара
+        img.convert("RGB").save(buf, format="JPEG", quality=quality, subsampling=0)
+    elif fmt == "webp":
+        img.save(buf, format="WEBP", quality=quality, method=4)
+    else:
+        raise ValueError(f"Неизвестный формат результата: {fmt}")
+    return buf.getvalue()
+
+
+# render_* возвращают (байты результата, {этап: секунды}) — время меряем внутри
+# процесса пула, чтобы в метриках композиция и кодирование были видны раздельно
+
+def render_studio(subject_png: bytes, bg_bytes: bytes, output: tuple[str, int, int]) -> tuple[bytes, dict]:
+    """Студийная композиция: фон + объект с тенью, результат в формате output."""
+    t0 = time.perf_counter()
+    bg = Image.open(io.BytesIO(bg_bytes)).convert("RGB")
+    result = compose_subject_on_bg(subject_png, bg)
+    t1 = time.perf_counter()
+    data = encode_image(result, output)
+    return data, {"compose": t1 - t0, "encode": time.perf_counter() - t1}
+
+
+def render_seamless(subject_png: bytes, bg_bytes: bytes, scale_by_height: float, cx: float, cy: float,
+                    output: tuple[str, int, int]) -> tuple[bytes, dict]:
+    """Бесшовное встраивание; центр задаётся долями ширины/высоты фона."""
+    t0 = time.perf_counter()
+    bg = Image.open(io.BytesIO(bg_bytes)).convert("RGB")
+    bw, bh = bg.size
+    result = seamless_place(subject_png, bg, scale_by_height=scale_by_height,
+                            x_center=int(bw * cx), y_center=int(bh * cy))
+    t1 = time.perf_counter()
+    data = encode_image(result, output)
+    return data, {"compose": t1 - t0, "encode": time.perf_counter() - t1}
+
+
+def warm_up() -> float:
+    """Прогрев процесса пула: первые вызовы PIL/OpenCV (кодеки, буферы) заметно медленнее следующих."""
+    t0 = time.perf_counter()
+    subject = Image.new("RGBA", (96, 128), (0, 0, 0, 0))
+    subject.paste((200, 60, 60, 255), (16, 16, 80, 112))
+    subject_png = encode_image(subject, ("png", 0, 1))
+    bg_png = encode_image(Image.new("RGB", (256, 256), (180, 180, 180)), ("png", 0, 1))
+    render_studio(subject_png, bg_png, ("jpeg", 90, 1))
+    render_seamless(subject_png, bg_png, 0.4, 0.5, 0.5, ("webp", 90, 1))
+    return time.perf_counter() - t0
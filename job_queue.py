@@ -0,0 +1,197 @@
+# job_queue.py — персистентная очередь задач генерации.
+#
+# Хэндлер кладёт задачу в таблицу gen_jobs и сразу отвечает Telegram; воркеры
+# (в этом же процессе или отдельными процессами/хостами) забирают задачи.
+# Забранная задача «невидима» для других воркеров до visible_at; воркер
+# продлевает её heartbeat'ом, а если он умер — задачу заберёт другой.
+#
+# Порядок выдачи — честный между чатами (weighted fair queuing): сначала класс
+# приоритета, затем «виртуальное время окончания» — сумма стоимостей (число
+# вариантов) задач чата до этой включительно: активных и завершённых за последние
+# fair_window секунд. Чат с пятью задачами по пять вариантов не задерживает того,
+# кто просит один. Ожидание постепенно снижает оценку (aging), поэтому тяжёлые
+# задачи тоже не голодают.
+
+import json
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from db import Database
+
+
+class PermanentError(RuntimeError):
+    """Ошибка, которую повтор не исправит (не картинка, неверный ключ API, отказ модерации):
+    задача проваливается сразу, без повторов."""
+
+
+@dataclass
+class Job:
+    id: int
+    chat_id: int
+    payload: dict
+    attempts: int
+    max_attempts: int
+    progress: int
+    created_at: float
+
+
+class JobQueue:
+    def __init__(self, db: Database, max_attempts: int = 3, retry_backoff: float = 10.0,
+                 aging: float = 60.0, fair_window: float = 600.0):
+        self.db = db
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.aging = aging  # секунд ожидания на единицу стоимости
+        self.fair_window = fair_window  # сколько помнить обслуженные задачи чата
+
+    async def setup(self):
+        db = self.db
+
+        def create(cur):
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS gen_jobs (
+                    id {db.serial_pk},
+                    chat_id BIGINT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    max_attempts INTEGER NOT NULL,
+                    progress INTEGER NOT NULL DEFAULT 0,
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    cost INTEGER NOT NULL DEFAULT 1,
+                    visible_at DOUBLE PRECISION NOT NULL,
+                    locked_by TEXT,
+                    last_error TEXT,
+                    created_at DOUBLE PRECISION NOT NULL,
+                    updated_at DOUBLE PRECISION NOT NULL
+                )""")
+            cur.execute("CREATE INDEX IF NOT EXISTS gen_jobs_ready ON gen_jobs (status, visible_at)")
+            cur.execute("CREATE INDEX IF NOT EXISTS gen_jobs_updated ON gen_jobs (updated_at)")
+            # Таблицы, созданные до появления приоритетов
+            for column in ("priority INTEGER NOT NULL DEFAULT 0", "cost INTEGER NOT NULL DEFAULT 1"):
+                if db.dialect == "postgres":
+                    cur.execute(f"ALTER TABLE gen_jobs ADD COLUMN IF NOT EXISTS {column}")
+                else:
+                    cur.execute("PRAGMA table_info(gen_jobs)")
+                    if column.split()[0] not in {row[1] for row in cur.fetchall()}:
+                        cur.execute(f"ALTER TABLE gen_jobs ADD COLUMN {column}")
+
+        await db.run(create)
+
+    def _ranked(self) -> str:
+        """Задачи с оценкой очерёдности; параметры — _ranked_params()."""
+        return (
+            "SELECT id, priority, status, visible_at, "
+            "SUM(cost) OVER (PARTITION BY chat_id ORDER BY created_at, id ROWS UNBOUNDED PRECEDING) "
+            "- (? - created_at) / ? AS score "
+            "FROM gen_jobs WHERE status IN ('queued', 'running') OR updated_at >= ?")
+
+    def _ranked_params(self, now: float) -> tuple:
+        return now, self.aging, now - self.fair_window
+
+    async def enqueue(self, chat_id: int, payload: dict, priority: int = 0, cost: int = 1) -> int:
+        """Поставить задачу; priority — класс (больше — раньше), cost — её «вес» в честной очереди."""
+        db = self.db
+        now = time.time()
+
+        def insert(cur):
+            cur.execute(db.sql(
+                "INSERT INTO gen_jobs (chat_id, payload, max_attempts, priority, cost, visible_at, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)" + (" RETURNING id" if db.dialect == "postgres" else "")),
+                (chat_id, json.dumps(payload, ensure_ascii=False), self.max_attempts, priority, max(1, cost),
+                 now, now, now))
+            return cur.fetchone()[0] if db.dialect == "postgres" else cur.lastrowid
+
+        return await db.run(insert)
+
+    async def claim(self, worker_id: str, visibility_timeout: float) -> Optional[Job]:
+        """Забрать следующую готовую задачу: новую, отложенную на повтор или брошенную упавшим воркером."""
+        db = self.db
+        lock = " FOR UPDATE OF g SKIP LOCKED" if db.dialect == "postgres" else ""
+
+        def take(cur):
+            now = time.time()
+            # Условия на g повторяются, чтобы Postgres перепроверил строку, перехваченную другим воркером
+            cur.execute(db.sql(
+                "SELECT g.id, g.chat_id, g.payload, g.attempts, g.max_attempts, g.progress, g.created_at "
+                f"FROM gen_jobs g JOIN ({self._ranked()}) r ON r.id = g.id "
+                "WHERE r.visible_at <= ? AND g.visible_at <= ? AND g.status IN ('queued', 'running') "
+                "ORDER BY r.priority DESC, r.score, g.id LIMIT 1" + lock), (*self._ranked_params(now), now, now))
+            row = cur.fetchone()
+            if row is None:
+                return None
+            cur.execute(db.sql(
+                "UPDATE gen_jobs SET status = 'running', attempts = attempts + 1, locked_by = ?, "
+                "visible_at = ?, updated_at = ? WHERE id = ?"),
+                (worker_id, now + visibility_timeout, now, row[0]))
+            return Job(id=row[0], chat_id=row[1], payload=json.loads(row[2]), attempts=row[3] + 1,
+                       max_attempts=row[4], progress=row[5], created_at=row[6])
+
+        return await db.run(take)
+
+    async def position(self, job_id: int) -> Optional[int]:
+        """Место задачи среди ожидающих (1 — следующая); None — задача уже не в очереди."""
+        db = self.db
+
+        def rank(cur):
+            cur.execute(db.sql(
+                "SELECT pos FROM (SELECT id, ROW_NUMBER() OVER (ORDER BY priority DESC, score, id) AS pos "
+                f"FROM ({self._ranked()}) r WHERE status = 'queued') q WHERE id = ?"),
+                (*self._ranked_params(time.time()), job_id))
+            row = cur.fetchone()
+            return row[0] if row else None
+
+        return await db.run(rank)
+
+    async def heartbeat(self, job: Job, worker_id: str, visibility_timeout: float):
+        db = self.db
+        now = time.time()
+        await db.run(lambda cur: cur.execute(db.sql(
+            "UPDATE gen_jobs SET visible_at = ?, updated_at = ? WHERE id = ? AND locked_by = ? AND status = 'running'"),
+            (now + visibility_timeout, now, job.id, worker_id)))
+
+    async def save_progress(self, job: Job, progress: int):
+        db = self.db
+        job.progress = progress
+        await db.run(lambda cur: cur.execute(db.sql(
+            "UPDATE gen_jobs SET progress = ?, updated_at = ? WHERE id = ?"),
+            (progress, time.time(), job.id)))
+
+    async def complete(self, job: Job):
+        db = self.db
+        await db.run(lambda cur: cur.execute(db.sql(
+            "UPDATE gen_jobs SET status = 'done', locked_by = NULL, updated_at = ? WHERE id = ?"),
+            (time.time(), job.id)))
+
+    async def release(self, job: Job, worker_id: str):
+        """Вернуть прерванную задачу в очередь сразу (остановка воркера), не тратя попытку."""
+        db = self.db
+        now = time.time()
+        await db.run(lambda cur: cur.execute(db.sql(
+            "UPDATE gen_jobs SET status = 'queued', attempts = attempts - 1, visible_at = ?, locked_by = NULL, "
+            "updated_at = ? WHERE id = ? AND locked_by = ? AND status = 'running'"),
+            (now, now, job.id, worker_id)))
+
+    async def fail(self, job: Job, error: str, retry: bool = True) -> bool:
+        """Ошибка выполнения. Возвращает True, если задача будет повторена; retry=False — не повторять."""
+        db = self.db
+        now = time.time()
+        retry = retry and job.attempts < job.max_attempts
+        if retry:
+            # Экспоненциальная пауза перед повтором
+            delay = self.retry_backoff * 2 ** (job.attempts - 1)
+            params = ("queued", now + delay, error, now, job.id)
+        else:
+            params = ("failed", now, error, now, job.id)
+        await db.run(lambda cur: cur.execute(db.sql(
+            "UPDATE gen_jobs SET status = ?, visible_at = ?, locked_by = NULL, last_error = ?, updated_at = ? "
+            "WHERE id = ?"), params))
+        return retry
+
+    async def purge(self, older_than: float):
+        """Удаление завершённых и проваленных задач старше older_than секунд."""
+        db = self.db
+        await db.run(lambda cur: cur.execute(db.sql(
+            "DELETE FROM gen_jobs WHERE status IN ('done', 'failed') AND updated_at < ?"),
+            (time.time() - older_than,)))
@@ -0,0 +1,124 @@
+# metrics.py — метрики Prometheus: время этапов, задачи в работе, ответы внешних API.
+#
+# Веб-процесс отдаёт их на /metrics; отдельный воркер — на своём порту
+# (METRICS_PORT). Если включена трассировка, по каждой задаче в лог пишется
+# строка с длительностью этапов.
+
+import contextvars
+import logging
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import REGISTRY, Collector
+
+# Этапы длятся от миллисекунд (кэш) до минут (DALL-E под нагрузкой)
+_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+STAGE_SECONDS = Histogram("photobot_stage_seconds", "Длительность этапа обработки", ["stage"], buckets=_BUCKETS)
+STAGE_IN_FLIGHT = Gauge("photobot_stage_in_flight", "Сколько операций этапа выполняется сейчас", ["stage"])
+JOB_SECONDS = Histogram("photobot_job_seconds", "Время выполнения задачи генерации", buckets=_BUCKETS)
+JOBS_IN_FLIGHT = Gauge("photobot_jobs_in_flight", "Задачи генерации в работе")
+JOBS_TOTAL = Counter("photobot_jobs_total", "Завершённые попытки задач", ["result"])
+QUEUE_WAIT_SECONDS = Histogram("photobot_queue_wait_seconds", "Ожидание задачи в очереди", buckets=_BUCKETS)
+API_RESPONSES = Counter("photobot_api_responses_total", "Ответы внешних API", ["api", "status"])
+STARTUP_SECONDS = Gauge("photobot_startup_seconds", "Длительность этапов запуска процесса", ["phase"])
+TELEGRAM_EDITS_SKIPPED = Counter("photobot_telegram_edits_skipped_total", "Неотправленные правки сообщений", ["reason"])
+
+# Трасса текущей задачи: список (этап, секунды); None — трассировки нет
+_trace: contextvars.ContextVar[Optional[list]] = contextvars.ContextVar("photobot_trace", default=None)
+
+
+@contextmanager
+def stage(name: str):
+    """Замер этапа: гистограмма, счётчик «в работе» и запись в трассу задачи."""
+    STAGE_IN_FLIGHT.labels(name).inc()
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - t0)
+        STAGE_IN_FLIGHT.labels(name).dec()
+
+
+def observe(name: str, seconds: float):
+    """Учесть длительность этапа, измеренную в другом месте (например, в пуле процессов)."""
+    STAGE_SECONDS.labels(name).observe(seconds)
+    trace = _trace.get()
+    if trace is not None:
+        trace.append((name, seconds))
+
+
+@contextmanager
+def job_trace(job_id: int, log: bool):
+    """Общий замер задачи; при log=True этапы задачи пишутся в лог одной строкой."""
+    trace = []
+    token = _trace.set(trace)
+    JOBS_IN_FLIGHT.inc()
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        total = time.perf_counter() - t0
+        JOB_SECONDS.observe(total)
+        JOBS_IN_FLIGHT.dec()
+        _trace.reset(token)
+        if log:
+            # Этапы вариантов идут параллельно, поэтому сумма может быть больше общего времени
+            parts = " ".join(f"{name}={sec:.2f}s" for name, sec in trace)
+            logging.info(f"Трасса задачи #{job_id}: всего {total:.2f}s | {parts}")
+
+
+@contextmanager
+def startup_phase(name: str):
+    """Замер этапа запуска (импорт, прогрев): gauge и строка в лог."""
+    t0 = time.perf_counter()
+    yield
+    startup_done(name, time.perf_counter() - t0)
+
+
+def startup_done(name: str, seconds: float):
+    STARTUP_SECONDS.labels(name).set(seconds)
+    logging.info(f"Запуск: {name} — {seconds:.2f} с")
+
+
+class StatsCollector(Collector):
+    """Экспорт словаря stats() (кэш вырезок, пул фонов) как набора gauge-метрик."""
+
+    def __init__(self, prefix: str, stats: Callable[[], dict]):
+        self.prefix = prefix
+        self.stats = stats
+
+    def collect(self):
+        for key, value in self.stats().items():
+            yield GaugeMetricFamily(f"{self.prefix}_{key}", f"{self.prefix}: {key}", value=value)
+
+
+def register_stats(prefix: str, stats: Callable[[], dict]):
+    REGISTRY.register(StatsCollector(prefix, stats))
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Время и результат каждого запроса к Bot API."""
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        status = "ok"
+        with stage(f"telegram_{name}"):
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter:
+                status = "429"
+                raise
+            except TelegramAPIError as e:
+                status = type(e).__name__
+                raise
+            except Exception:
+                status = "error"
+                raise
+            finally:
+                API_RESPONSES.labels("telegram", status).inc()
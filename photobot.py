@@ -0,0 +1,1068 @@
+# photobot.py — бот «Предметный фотограф» (адаптированная версия для Railway).
+#
+# Запускается через main_bot.py: процессы пула обработки изображений (spawn) заново
+# выполняют главный скрипт, поэтому этот модуль с ботом, БД и кэшами главным не делаем.
+
+import os
+import base64
+import asyncio
+import importlib.util
+import multiprocessing
+import socket
+import sys
+import tempfile
+import time
+import logging
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import AsyncExitStack, asynccontextmanager
+from datetime import datetime
+from enum import Enum
+from pathlib import Path
+from typing import Optional
+
+# Начало импорта модуля — время до готовности пишется в метрики (см. конец файла)
+IMPORT_STARTED = time.perf_counter()
+
+# Загрузка переменных окружения из .env файла (для локального тестирования)
+from dotenv import load_dotenv
+load_dotenv()
+
+# Основные библиотеки для работы с API и изображениями
+import aiohttp
+
+# Метрики
+import metrics
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest, start_http_server
+
+# Обработка изображений (выполняется в пуле процессов) и удаление фона.
+# imaging тянет PIL/numpy/cv2, поэтому загружается при первом обращении (в прогреве,
+# см. warm_up) — веб-сервер занимает порт, не дожидаясь тяжёлых библиотек.
+def lazy_import(name: str):
+    if name in sys.modules:
+        return sys.modules[name]  # уже загружен (например, тестами или другим модулем) — не подменяем
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+imaging = lazy_import("imaging")
+from cutout import CutoutBackend, FallbackBackend, PixelcutBackend, RembgBackend, api_error
+from cutout_cache import CutoutCache, cache_key
+from bg_pool import BackgroundPool
+from telegram_limits import TelegramRateLimiter
+
+# Очередь задач генерации
+from db import Database
+from job_queue import Job, JobQueue, PermanentError
+from fsm_storage import SQLStorage
+
+# Библиотеки для Telegram-бота (aiogram 3.x)
+from aiogram import Bot, Dispatcher, F, Router, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
+from aiogram.types import Message, FSInputFile, BufferedInputFile, InputMediaDocument
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.context import FSMContext
+from aiogram.filters import CommandStart
+from aiogram.utils.keyboard import ReplyKeyboardBuilder
+
+# Библиотеки для веб-сервера (вебхук)
+from aiohttp import web
+
+
+# ========= 1. КОНФИГУРАЦИЯ И ПЕРЕМЕННЫЕ =========
+
+# Обязательно укажи эти переменные в настройках Railway
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+PIXELCUT_API_KEY = os.getenv("PIXELCUT_API_KEY")
+
+# WEBHOOK_BASE_URL - это публичный URL, который предоставляет Railway.
+# Убираем лишние символы на всякий случай.
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "").strip().rstrip('/')
+
+# Необязательные переменные
+ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
+MAIN_BOT_USERNAME = os.getenv("MAIN_BOT_USERNAME", "")
+
+# Адреса внешних API (переопределяются для локального стенда, см. bench_load.py)
+OPENAI_API_BASE = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1").rstrip('/')
+PIXELCUT_API_URL = os.getenv("PIXELCUT_API_URL", "https://api.pixelcut.ai/v1/remove-background")
+TELEGRAM_API_SERVER = os.getenv("TELEGRAM_API_SERVER", "").rstrip('/')
+TELEGRAM_API = TelegramAPIServer.from_base(TELEGRAM_API_SERVER) if TELEGRAM_API_SERVER else PRODUCTION
+
+# Лимиты исходящих запросов к Telegram: всего сообщений в секунду на бота
+# и на один чат (с запасом TG_CHAT_BURST); сколько раз повторять после 429.
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "25"))
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))
+TG_CHAT_BURST = float(os.getenv("TG_CHAT_BURST", "3"))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "5"))
+
+# Пул HTTP-соединений к внешним API (OpenAI, Pixelcut)
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "32"))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "16"))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "120"))
+
+# Ограничения параллельности генерации: всего одновременных запросов к OpenAI
+# (под наш rate limit) и одновременных вариантов на один чат.
+# Оба лимита — на процесс: с отдельными воркерами (main_bot.py worker) к OpenAI идёт
+# до OPENAI_CONCURRENCY x число процессов запросов, общий лимит делите между ними.
+OPENAI_CONCURRENCY = int(os.getenv("OPENAI_CONCURRENCY", "5"))
+PER_CHAT_CONCURRENCY = int(os.getenv("PER_CHAT_CONCURRENCY", "2"))
+
+# Пул для CPU-тяжёлой обработки изображений. IMAGING_PROCESSES=0 — только потоки.
+# Небольшие изображения дешевле обработать в потоке, чем гонять через pickle в процесс.
+# По умолчанию — доступные процессу ядра, но не больше 4: квоты CPU контейнера
+# (cgroups) отсюда не видны, на большом хосте лучше задать IMAGING_PROCESSES явно.
+_AVAILABLE_CPUS = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+IMAGING_PROCESSES = int(os.getenv("IMAGING_PROCESSES", str(min(4, _AVAILABLE_CPUS))))
+IMAGING_THREADS = int(os.getenv("IMAGING_THREADS", "2"))
+IMAGING_PROCESS_MIN_BYTES = int(os.getenv("IMAGING_PROCESS_MIN_BYTES", str(512 * 1024)))
+
+# Результат: png | jpeg | webp (расширения файлов — OUTPUT_EXTENSIONS). Качество — для JPEG/WebP, compress_level (0-9) — для PNG.
+# SEND_AS_ALBUM=1 — все варианты одним альбомом (sendMediaGroup), 0 — каждый по готовности.
+OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "png").strip().lower()
+OUTPUT_QUALITY = int(os.getenv("OUTPUT_QUALITY", "92"))
+PNG_COMPRESS_LEVEL = int(os.getenv("PNG_COMPRESS_LEVEL", "3"))
+SEND_AS_ALBUM = os.getenv("SEND_AS_ALBUM", "1") == "1"
+
+# Загрузки из Telegram крупнее этого порога пишутся во временный файл на диске
+DOWNLOAD_SPOOL_MAX_BYTES = int(os.getenv("DOWNLOAD_SPOOL_MAX_BYTES", str(1024 * 1024)))
+
+# Исходник перед удалением фона ужимаем до этой длинной стороны (фоны — не больше 1792)
+INPUT_MAX_EDGE = int(os.getenv("INPUT_MAX_EDGE", "2048"))
+
+# Удаление фона: pixelcut — API Pixelcut, local — локальная модель rembg,
+# local+pixelcut — локально, а при ошибке через Pixelcut.
+CUTOUT_BACKEND = os.getenv("CUTOUT_BACKEND", "pixelcut").strip().lower()
+REMBG_MODEL = os.getenv("REMBG_MODEL", "u2net")
+REMBG_THREADS = int(os.getenv("REMBG_THREADS", "0"))  # 0 — по умолчанию onnxruntime
+REMBG_WORKERS = int(os.getenv("REMBG_WORKERS", "1"))
+
+# Кэш вырезок: LRU в памяти + каталог на диске (пустой CUTOUT_CACHE_DIR — без диска)
+CUTOUT_CACHE_DIR = os.getenv("CUTOUT_CACHE_DIR", str(Path(__file__).parent / "cache" / "cutouts"))
+CUTOUT_CACHE_MEM_MB = int(os.getenv("CUTOUT_CACHE_MEM_MB", "64"))
+CUTOUT_CACHE_DISK_MB = int(os.getenv("CUTOUT_CACHE_DISK_MB", "512"))
+CUTOUT_CACHE_TTL = int(os.getenv("CUTOUT_CACHE_TTL", str(24 * 3600)))  # секунды
+
+# Пул готовых фонов для пресетов (по умолчанию выключен: каждый фон — платная HD-генерация).
+# Глубина — сколько фонов держим на каждую пару (промпт, размер); MAX_USES — сколько
+# раз один фон можно выдать, прежде чем он будет удалён и заменён новым.
+# Каталог общий для процессов; догенерирует только один из них (см. bg_pool.py).
+# Без BG_POOL_PREFILL пополняются только пары, которые уже кто-то запрашивал. С ним —
+# сразу все: 6 пресетов × 3 расположения × 3 размера × DEPTH = 108 генераций DALL-E 3 HD
+# при DEPTH=2, и так при каждом старте с пустым диском (эфемерный диск Railway — каждый деплой).
+BG_POOL_ENABLED = os.getenv("BG_POOL_ENABLED", "0") == "1"
+BG_POOL_PREFILL = os.getenv("BG_POOL_PREFILL", "0") == "1"
+BG_POOL_DIR = os.getenv("BG_POOL_DIR", str(Path(__file__).parent / "cache" / "backgrounds"))
+BG_POOL_DEPTH = int(os.getenv("BG_POOL_DEPTH", "2"))
+BG_POOL_MAX_USES = int(os.getenv("BG_POOL_MAX_USES", "1"))
+BG_POOL_TTL = int(os.getenv("BG_POOL_TTL", str(7 * 24 * 3600)))  # секунды
+
+# Очередь задач: Postgres (DATABASE_URL на Railway) или SQLite для локального запуска.
+# Веб-процесс сам выполняет EMBEDDED_WORKERS задач одновременно (0 — только ставит в очередь);
+# дополнительные воркеры запускаются командой `python3 main_bot.py worker`.
+JOB_QUEUE_URL = os.getenv("JOB_QUEUE_URL") or os.getenv("DATABASE_URL") or f"sqlite:///{Path(__file__).parent / 'jobs.sqlite3'}"
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+EMBEDDED_WORKERS = int(os.getenv("EMBEDDED_WORKERS", "2"))
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "2"))
+JOB_VISIBILITY_TIMEOUT = float(os.getenv("JOB_VISIBILITY_TIMEOUT", "300"))  # секунды
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_BACKOFF = float(os.getenv("JOB_RETRY_BACKOFF", "10"))  # секунды, удваивается с каждой попыткой
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1"))
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", str(7 * 24 * 3600)))  # сколько хранить завершённые задачи
+
+# Честная очередь: задачи чатов чередуются с учётом числа вариантов. PRIORITY_CHATS —
+# чаты через запятую, которые обслуживаются вне общей очереди (ADMIN_ID — всегда первым).
+# JOB_FAIR_AGING — сколько секунд ожидания засчитываются за один вариант (защита от голодания),
+# JOB_FAIR_WINDOW — сколько секунд помнить уже выполненные задачи чата.
+PRIORITY_CHATS = {int(c) for c in os.getenv("PRIORITY_CHATS", "").replace(" ", "").split(",") if c}
+JOB_FAIR_AGING = float(os.getenv("JOB_FAIR_AGING", "60"))
+JOB_FAIR_WINDOW = float(os.getenv("JOB_FAIR_WINDOW", "600"))
+
+# Хранилище FSM: по умолчанию DATABASE_URL (Postgres); sqlite:///... — для тестов.
+# Пустое значение и отсутствие DATABASE_URL — MemoryStorage (только одна реплика).
+FSM_STORAGE_URL = os.getenv("FSM_STORAGE_URL", os.getenv("DATABASE_URL", ""))
+FSM_TTL = float(os.getenv("FSM_TTL", str(24 * 3600)))  # брошенные диалоги, секунды
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "0.2"))
+
+# Метрики: веб-процесс отдаёт их на /metrics, отдельный воркер — на METRICS_PORT (0 — не отдаёт).
+# METRICS_JOB_TRACE=1 — писать в лог длительность этапов каждой задачи.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_JOB_TRACE = os.getenv("METRICS_JOB_TRACE", "0") == "1"
+
+# Проверка наличия обязательных переменных
+OUTPUT_EXTENSIONS = {"png": "png", "jpeg": "jpg", "webp": "webp"}  # форматы imaging.encode_image
+if OUTPUT_FORMAT not in OUTPUT_EXTENSIONS:
+    raise RuntimeError(f"Неизвестный OUTPUT_FORMAT: {OUTPUT_FORMAT} (ожидается png, jpeg или webp)")
+OUTPUT_SPEC = (OUTPUT_FORMAT, OUTPUT_QUALITY, PNG_COMPRESS_LEVEL)
+OUTPUT_EXT = OUTPUT_EXTENSIONS[OUTPUT_FORMAT]
+if CUTOUT_BACKEND not in ("pixelcut", "local", "local+pixelcut"):
+    raise RuntimeError(f"Неизвестный CUTOUT_BACKEND: {CUTOUT_BACKEND} (ожидается pixelcut, local или local+pixelcut)")
+if not all([BOT_TOKEN, OPENAI_API_KEY, WEBHOOK_BASE_URL]):
+    raise RuntimeError("Одна или несколько обязательных переменных окружения (BOT_TOKEN, OPENAI_API_KEY, WEBHOOK_BASE_URL) не заданы!")
+if "pixelcut" in CUTOUT_BACKEND and not PIXELCUT_API_KEY:
+    raise RuntimeError(f"Для CUTOUT_BACKEND={CUTOUT_BACKEND} нужна переменная окружения PIXELCUT_API_KEY!")
+
+# Настройка логирования для отладки
+logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s: %(message)s")
+
+# Инициализация объектов aiogram
+bot = Bot(BOT_TOKEN, session=AiohttpSession(api=TELEGRAM_API))
+# Лимитер — внешний слой: метрики видят каждый фактический запрос, включая 429
+bot.session.middleware(TelegramRateLimiter(global_rate=TG_GLOBAL_RATE, chat_rate=TG_CHAT_RATE,
+                                           chat_burst=TG_CHAT_BURST, max_retries=TG_MAX_RETRIES))
+bot.session.middleware(metrics.TelegramMetricsMiddleware())
+# Состояния диалогов — в общей БД, если она настроена (несколько реплик, переживает
+# рестарты), иначе в памяти процесса
+if FSM_STORAGE_URL:
+    storage = SQLStorage(Database(FSM_STORAGE_URL, pool_size=DB_POOL_SIZE),
+                         ttl=FSM_TTL, flush_interval=FSM_FLUSH_INTERVAL)
+else:
+    storage = MemoryStorage()
+dp = Dispatcher(storage=storage)
+router = Router()
+dp.include_router(router)
+
+
+# ========= 2. ТЕКСТЫ И КЛАВИАТУРЫ =========
+
+WELCOME = (
+    "👋 Привет! Ты в боте «Предметный фотограф».\n\n"
+    "Он поможет:\n"
+    "• сделать качественные предметные фото,\n"
+    "• заменить фон без потери формы, цвета и надписей,\n"
+    "• создать атмосферные сцены (студийно / на человеке / в руках).\n\n"
+    "🔐 Чтобы начать, нажми «СТАРТ»."
+)
+
+REQUIREMENTS = (
+    "📥 Добавь своё фото.\n\n"
+    "Требования к исходнику для лучшего результата:\n"
+    "• Ровный свет без жёстких теней.\n"
+    "• Нейтральный однотонный фон.\n"
+    "• Предмет целиком, края не обрезаны.\n"
+    "• Максимальное качество (лучше «Документ», чтобы Telegram не сжимал)."
+)
+
+# Файл шпаргалки создаётся при первом запросе; PROMPTS_FILE — другое место (стенд, read-only образ)
+PROMPTS_FILE = Path(os.getenv("PROMPTS_FILE", str(Path(__file__).parent / "prompts_cheatsheet.md")))
+PROMPTS_MD = """# 📓 Шпаргалка по промптам для генерации сцен
+(сокращено) — опиши фон/свет/настроение, без товара; английский, короткими фразами.
+Примеры: studio soft light; dark premium look; glossy marble; cozy interior, warm sunlight; etc.
+"""
+
+# ========= Состояния (FSM) =========
+class GenStates(StatesGroup):
+    waiting_start = State()
+    waiting_photo = State()
+    waiting_size = State()
+    waiting_variants = State()
+    waiting_style = State()
+    waiting_placement = State()
+    generating = State()
+
+# ========= Клавиатуры =========
+class Placement(str, Enum):
+    STUDIO = "Студийно (на фоне)"
+    ON_BODY = "На человеке (украшение/одежда)"
+    IN_HAND = "В руках (крупный план)"
+
+start_kb = ReplyKeyboardBuilder()
+start_kb.button(text="СТАРТ")
+start_kb.button(text="📓 Шпаргалка по промтам")
+start_kb.adjust(2)
+START_KB = start_kb.as_markup(resize_keyboard=True)
+
+place_kb = ReplyKeyboardBuilder()
+for p in (Placement.STUDIO.value, Placement.ON_BODY.value, Placement.IN_HAND.value):
+    place_kb.button(text=p)
+place_kb.adjust(1)
+PLACEMENT_KB = place_kb.as_markup(resize_keyboard=True)
+
+PRESETS = [
+    "Каталог: чистый студийный фон, мягкая тень",
+    "Минимализм: однотон, мягкие тени",
+    "Тёмный премиум: low-key, контровый свет",
+    "Мрамор/глянец: контролируемые блики",
+    "Nature: дерево/лен/зелень, дневной свет",
+    "Flat lay: вид сверху, минимум пропсов",
+]
+style_kb_builder = ReplyKeyboardBuilder()
+for p in PRESETS:
+    style_kb_builder.button(text=p)
+style_kb_builder.button(text="Своя сцена (опишу текстом)")
+style_kb_builder.adjust(1)
+STYLE_KB = style_kb_builder.as_markup(resize_keyboard=True)
+
+size_kb = ReplyKeyboardBuilder()
+for s in ("1:1", "4:5", "3:4", "16:9", "9:16"):
+    size_kb.button(text=s)
+size_kb.adjust(3, 2)
+SIZE_KB = size_kb.as_markup(resize_keyboard=True)
+
+var_kb = ReplyKeyboardBuilder()
+for n in ("1", "2", "3", "4", "5"):
+    var_kb.button(text=n)
+var_kb.adjust(5)
+VAR_KB = var_kb.as_markup(resize_keyboard=True)
+
+# Соотношение сторон -> размер, который поддерживает DALL-E 3
+OPENAI_SIZES = {"1:1": "1024x1024", "4:5": "1024x1792", "3:4": "1024x1792", "16:9": "1792x1024", "9:16": "1024x1792"}
+
+
+# ========= 3. ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ =========
+
+def ensure_prompts_file():
+    if not PROMPTS_FILE.exists():
+        PROMPTS_FILE.write_text(PROMPTS_MD, encoding="utf-8")
+
+def scene_prompt(style_text: str, placement: str) -> str:
+    prompts = {
+        Placement.STUDIO.value: f"{style_text}. Studio lighting, photorealistic.",
+        Placement.ON_BODY.value: f"{style_text}. Photorealistic human, soft light.",
+        Placement.IN_HAND.value: f"{style_text}. Photorealistic hands close-up, soft light."
+    }
+    return prompts.get(placement, style_text)
+
+def file_ref_from_message(message: Message) -> tuple[str, str]:
+    """(file_id, file_unique_id) присланного фото/документа — само изображение скачиваем только при генерации."""
+    if message.document:
+        return message.document.file_id, message.document.file_unique_id
+    elif message.photo:
+        return message.photo[-1].file_id, message.photo[-1].file_unique_id
+    else:
+        raise ValueError("В сообщении нет фото/документа")
+
+@asynccontextmanager
+async def downloaded_file(file_id: str):
+    """Исходник из Telegram: небольшой — bytes в памяти, крупный — путь к временному файлу.
+
+    Крупный файл пишется на диск потоком и целиком в память не читается:
+    imaging.normalize_input открывает его сам.
+    """
+    path = None
+    try:
+        with metrics.stage("download"):
+            file = await bot.get_file(file_id)
+            if file.file_size is not None and file.file_size <= DOWNLOAD_SPOOL_MAX_BYTES:
+                source = (await bot.download_file(file.file_path)).getvalue()
+            else:
+                fd, name = tempfile.mkstemp(prefix="photobot-", suffix=".upload")
+                os.close(fd)
+                source = path = Path(name)
+                await bot.download_file(file.file_path, destination=path)
+        yield source
+    finally:
+        if path is not None:
+            path.unlink(missing_ok=True)
+
+# ========= 4. ЛОГИКА ОБРАБОТКИ ИЗОБРАЖЕНИЙ =========
+
+# Общая HTTP-сессия для внешних API: одна на процесс, открывается в on_startup.
+# Keep-alive и кэш DNS избавляют от TLS-рукопожатия и резолва на каждый запрос.
+http_session: Optional[aiohttp.ClientSession] = None
+
+
+async def open_http_session() -> aiohttp.ClientSession:
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            resolver=aiohttp.AsyncResolver(),  # aiodns
+        )
+        http_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+        )
+    return http_session
+
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    if http_session is None or http_session.closed:
+        raise RuntimeError("HTTP-сессия не открыта (on_startup ещё не выполнен?)")
+    return http_session
+
+
+def build_cutout_backend() -> CutoutBackend:
+    local = RembgBackend(model=REMBG_MODEL, threads=REMBG_THREADS, workers=REMBG_WORKERS)
+    pixelcut = PixelcutBackend(PIXELCUT_API_KEY, get_http_session, endpoint=PIXELCUT_API_URL)
+    if CUTOUT_BACKEND == "local":
+        return local
+    if CUTOUT_BACKEND == "local+pixelcut":
+        return FallbackBackend(local, pixelcut)
+    return pixelcut
+
+
+cutout_backend = build_cutout_backend()
+cutout_cache = CutoutCache(
+    directory=Path(CUTOUT_CACHE_DIR) if CUTOUT_CACHE_DIR else None,
+    mem_max_bytes=CUTOUT_CACHE_MEM_MB * 1024 * 1024,
+    disk_max_bytes=CUTOUT_CACHE_DISK_MB * 1024 * 1024,
+    ttl=CUTOUT_CACHE_TTL,
+)
+
+
+async def remove_background(file_id: str, file_unique_id: str) -> bytes:
+    """Удаление фона выбранным бэкендом (CUTOUT_BACKEND) с кэшем по file_unique_id.
+
+    При попадании в кэш исходник даже не скачивается из Telegram.
+    """
+    key = cache_key(cutout_backend.name, file_unique_id)
+    cut_png = await cutout_cache.get(key)
+    if cut_png is not None:
+        logging.info(f"Вырезка взята из кэша: {cutout_cache.stats()}")
+        return cut_png
+
+    async with downloaded_file(file_id) as source:
+        with metrics.stage("normalize"):
+            try:
+                jpg_bytes = await run_imaging(imaging.normalize_input, source, INPUT_MAX_EDGE)
+            except imaging.Image.UnidentifiedImageError:
+                raise PermanentError("Не получилось открыть файл как изображение — пришли фото в JPEG или PNG")
+    with metrics.stage(f"cutout_{cutout_backend.name}"):
+        cut_png = await cutout_backend.remove(jpg_bytes)
+    # Обрезаем прозрачные поля один раз — дальше масштабируем и кэшируем только сам объект
+    with metrics.stage("trim"):
+        cut_png = await run_imaging(imaging.trim_transparent, cut_png)
+    await cutout_cache.put(key, cut_png)
+    return cut_png
+
+
+async def generate_background(prompt: str, size: str) -> bytes:
+    """Генерация фона через API OpenAI DALL-E 3. Возвращает байты изображения (PNG)."""
+    endpoint = f"{OPENAI_API_BASE}/images/generations"
+    headers = {"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"}
+    payload = {
+        "model": "dall-e-3",
+        "prompt": f"High-quality product photography background only. {prompt}",
+        "size": size,
+        "n": 1,
+        "quality": "hd",
+        "response_format": "b64_json"
+    }
+    session = get_http_session()
+    try:
+        async with session.post(endpoint, headers=headers, json=payload) as response:
+            metrics.API_RESPONSES.labels("openai", str(response.status)).inc()
+            if response.status != 200:
+                detail = await response.text()
+                raise api_error(response.status, f"Ошибка генерации фона OpenAI ({response.status}): {detail}")
+            body = await response.json()
+    except aiohttp.ClientError as e:
+        metrics.API_RESPONSES.labels("openai", "error").inc()
+        raise RuntimeError(f"Не удалось подключиться к OpenAI: {e}")
+    
+    b64_json = body["data"][0]["b64_json"]
+    return base64.b64decode(b64_json)
+
+
+async def generate_pool_background(prompt: str, size: str) -> bytes:
+    """Генерация фона для пула — под общим лимитом OpenAI, наравне с живыми запросами."""
+    async with openai_semaphore:
+        return await generate_background(prompt, size)
+
+
+bg_pool: Optional[BackgroundPool] = None
+if BG_POOL_ENABLED:
+    bg_pool = BackgroundPool(
+        directory=Path(BG_POOL_DIR),
+        depth=BG_POOL_DEPTH,
+        max_uses=BG_POOL_MAX_USES,
+        ttl=BG_POOL_TTL,
+        generate=generate_pool_background,
+    )
+
+
+metrics.register_stats("photobot_cutout_cache", cutout_cache.stats)
+if bg_pool is not None:
+    metrics.register_stats("photobot_bg_pool", bg_pool.stats)
+
+
+def preset_pool_keys() -> list[tuple[str, str]]:
+    """Все пары (промпт, размер) для пресетов — их пул заполняет заранее."""
+    sizes = sorted(set(OPENAI_SIZES.values()))
+    return [(scene_prompt(preset, placement.value), size)
+            for preset in PRESETS for placement in Placement for size in sizes]
+
+
+# ========= Пул обработки изображений =========
+
+process_pool: Optional[ProcessPoolExecutor] = None
+thread_pool: Optional[ThreadPoolExecutor] = None
+
+
+def _new_process_pool() -> ProcessPoolExecutor:
+    # spawn, а не fork: форк процесса с работающим event loop и потоками небезопасен
+    return ProcessPoolExecutor(
+        max_workers=IMAGING_PROCESSES,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=imaging.init_worker,
+    )
+
+
+def start_imaging_pools():
+    global process_pool, thread_pool
+    thread_pool = ThreadPoolExecutor(max_workers=IMAGING_THREADS, thread_name_prefix="imaging")
+    if IMAGING_PROCESSES > 0:
+        process_pool = _new_process_pool()
+
+
+def stop_imaging_pools():
+    global process_pool, thread_pool
+    if process_pool is not None:
+        process_pool.shutdown(wait=True, cancel_futures=True)
+        process_pool = None
+    if thread_pool is not None:
+        thread_pool.shutdown(wait=True, cancel_futures=True)
+        thread_pool = None
+
+
+def _pick_executor(args: tuple) -> Executor:
+    # Path — крупный исходник на диске (см. downloaded_file)
+    payload = sum(len(a) if isinstance(a, (bytes, bytearray)) else a.stat().st_size
+                  for a in args if isinstance(a, (bytes, bytearray, Path)))
+    if process_pool is not None and payload >= IMAGING_PROCESS_MIN_BYTES:
+        return process_pool
+    return thread_pool
+
+
+async def run_imaging(func, *args):
+    """Выполнить функцию из imaging вне event loop: крупные изображения — в процессе, мелкие — в потоке."""
+    global process_pool
+    loop = asyncio.get_running_loop()
+    executor = _pick_executor(args)
+    try:
+        return await loop.run_in_executor(executor, func, *args)
+    except BrokenProcessPool:
+        # Воркер упал (например, OOM) — пересоздаём пул, задачу доделываем в потоке.
+        # Ошибку получают все задачи сломанного пула: пересоздаёт только первая, иначе
+        # следующие закрыли бы уже новый пул вместе с чужими задачами в нём
+        if process_pool is executor:
+            logging.error("Пул обработки изображений сломан, пересоздаю")
+            process_pool = _new_process_pool()
+            executor.shutdown(wait=False)
+        return await loop.run_in_executor(thread_pool, func, *args)
+
+
+# ========= Ограничение параллельности =========
+
+# Лимит одновременных запросов к OpenAI — на процесс, не на всё развёртывание (см. OPENAI_CONCURRENCY)
+openai_semaphore = asyncio.Semaphore(OPENAI_CONCURRENCY)
+
+# Слоты по чатам: семафор живёт, пока им кто-то пользуется
+_chat_slots: dict[int, list] = {}
+
+
+@asynccontextmanager
+async def chat_slot(chat_id: int):
+    """Не даём одному пользователю занять все слоты генерации."""
+    entry = _chat_slots.get(chat_id)
+    if entry is None:
+        entry = _chat_slots[chat_id] = [asyncio.Semaphore(PER_CHAT_CONCURRENCY), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            _chat_slots.pop(chat_id, None)
+
+
+# ========= 5. ОБРАБОТЧИКИ СООБЩЕНИЙ (ХЭНДЛЕРЫ) =========
+
+@router.message(CommandStart())
+async def on_start(message: Message, state: FSMContext):
+    await state.clear()
+    ensure_prompts_file()
+    await message.answer(WELCOME, reply_markup=START_KB)
+    await state.set_state(GenStates.waiting_start)
+
+@router.message(GenStates.waiting_start, F.text == "📓 Шпаргалка по промтам")
+async def send_cheatsheet(message: Message):
+    try:
+        await message.answer_document(FSInputFile(PROMPTS_FILE))
+    except Exception:
+        await message.answer("⚠️ Файл со шпаргалкой пока недоступен.")
+
+@router.message(GenStates.waiting_start, F.text.casefold() == "старт")
+async def pressed_start(message: Message, state: FSMContext):
+    await message.answer(REQUIREMENTS)
+    await state.set_state(GenStates.waiting_photo)
+
+@router.message(GenStates.waiting_photo, F.photo | F.document)
+async def got_photo(message: Message, state: FSMContext):
+    try:
+        file_id, file_unique_id = file_ref_from_message(message)
+        await state.update_data(file_id=file_id, file_unique_id=file_unique_id)
+        await message.answer("Выбери расположение товара:", reply_markup=PLACEMENT_KB)
+        await state.set_state(GenStates.waiting_placement)
+    except Exception as e:
+        logging.error(f"Ошибка обработки фото: {e}")
+        await message.answer("Не удалось обработать фото. Попробуй другое.")
+
+@router.message(GenStates.waiting_placement, F.text)
+async def choose_placement(message: Message, state: FSMContext):
+    await state.update_data(placement=message.text)
+    await message.answer("Выбери размер (соотношение сторон):", reply_markup=SIZE_KB)
+    await state.set_state(GenStates.waiting_size)
+
+@router.message(GenStates.waiting_size, F.text)
+async def choose_size(message: Message, state: FSMContext):
+    await state.update_data(size_aspect=message.text)
+    await message.answer("Сколько вариантов сделать за один раз?", reply_markup=VAR_KB)
+    await state.set_state(GenStates.waiting_variants)
+
+@router.message(GenStates.waiting_variants, F.text)
+async def choose_variants(message: Message, state: FSMContext):
+    try:
+        n = int(message.text or "1")
+    except ValueError:
+        n = 1
+    await state.update_data(n_variants=min(5, max(1, n)))
+    await message.answer("Выбери сцену или опиши свою:", reply_markup=STYLE_KB)
+    await state.set_state(GenStates.waiting_style)
+
+
+@router.message(GenStates.waiting_style, F.text)
+async def generate_result(message: Message, state: FSMContext):
+    style_text = message.text
+    await state.update_data(style=style_text)
+
+    # Состояние — до постановки в очередь: быстрый воркер может сразу перевести диалог дальше
+    await state.set_state(GenStates.generating)
+    try:
+        data = await state.get_data()
+        payload = {
+            "user_id": message.from_user.id,
+            "file_id": data["file_id"],
+            "file_unique_id": data["file_unique_id"],
+            "placement": data.get("placement", Placement.STUDIO.value),
+            "size_aspect": data.get("size_aspect", "1:1"),
+            "n_variants": data.get("n_variants", 1),
+            "style": style_text,
+        }
+        job_id = await job_queue.enqueue(message.chat.id, payload, priority=job_priority(message.chat.id),
+                                         cost=payload["n_variants"])
+    except Exception as e:
+        logging.exception("Ошибка постановки задачи в очередь")
+        await message.answer(f"Что-то пошло не так 😥\nОшибка: {e}\n\nПопробуй ещё раз или начни с /start.")
+        await state.set_state(GenStates.waiting_photo) # Возвращаем на шаг отправки фото
+        return
+
+    position = await job_queue.position(job_id)
+    logging.info(f"Задача #{job_id} поставлена в очередь (чат {message.chat.id}, место {position})")
+    if position and position > 1:
+        await message.answer(f"Принято! Ты #{position} в очереди ⏳\nКак только подойдёт твой черёд, начну магию ✨",
+                             reply_markup=None)
+    else:
+        await message.answer("Принято! Начинаю магию ✨\nЭто может занять 1-2 минуты...", reply_markup=None)
+
+
+# ========= 6. ОЧЕРЕДЬ И ВОРКЕРЫ ГЕНЕРАЦИИ =========
+
+job_queue = JobQueue(Database(JOB_QUEUE_URL, pool_size=DB_POOL_SIZE),
+                     max_attempts=JOB_MAX_ATTEMPTS, retry_backoff=JOB_RETRY_BACKOFF,
+                     aging=JOB_FAIR_AGING, fair_window=JOB_FAIR_WINDOW)
+
+
+def job_priority(chat_id: int) -> int:
+    if ADMIN_ID and chat_id == ADMIN_ID:
+        return 2
+    return 1 if chat_id in PRIORITY_CHATS else 0
+
+
+async def run_generation(job: Job):
+    """Весь конвейер задачи: вырезка -> фон -> композиция -> отправка."""
+    chat_id = job.chat_id
+    data = job.payload
+    style_text = data["style"]
+    placement = data["placement"]
+    n_variants = data["n_variants"]
+    openai_size = OPENAI_SIZES.get(data["size_aspect"], "1024x1024")
+
+    # При повторе после сбоя уже отправленные варианты не генерируем заново
+    sent = job.progress
+    remaining = n_variants - sent
+
+    msg = await bot.send_message(chat_id, "Шаг 1/2: Удаляю фон с твоего фото...")
+    try:
+        cut_png = await remove_background(data["file_id"], data["file_unique_id"])
+
+        prompt = scene_prompt(style_text, placement)
+        from_pool = bg_pool is not None and style_text in PRESETS
+
+        async def render_variant() -> bytes:
+            bg = None
+            if from_pool:
+                with metrics.stage("background_pool"):
+                    bg = await bg_pool.take(prompt, openai_size)
+            if bg is None:
+                # Сначала слот чата, потом глобальный — чтобы не держать общий слот в ожидании своего
+                async with AsyncExitStack() as slots:
+                    with metrics.stage("openai_slot_wait"):
+                        await slots.enter_async_context(chat_slot(chat_id))
+                        await slots.enter_async_context(openai_semaphore)
+                    with metrics.stage("background_openai"):
+                        bg = await generate_background(prompt, size=openai_size)
+
+            with metrics.stage("render"):
+                if placement == Placement.STUDIO.value:
+                    result, timings = await run_imaging(imaging.render_studio, cut_png, bg, OUTPUT_SPEC)
+                else:
+                    scale = 0.26 if placement == Placement.ON_BODY.value else 0.40
+                    center_y = 0.4 if placement == Placement.ON_BODY.value else 0.5
+                    result, timings = await run_imaging(imaging.render_seamless, cut_png, bg, scale, 0.5, center_y, OUTPUT_SPEC)
+            for name, seconds in timings.items():
+                metrics.observe(name, seconds)
+            return result
+
+        async def deliver(results: list[bytes]):
+            # Номер варианта — по порядку готовности, а не запуска
+            nonlocal sent
+            files = [(sent + i + 1, BufferedInputFile(data, f"result_{sent + i + 1}.{OUTPUT_EXT}"))
+                     for i, data in enumerate(results)]
+            with metrics.stage("upload"):
+                if len(files) == 1:
+                    number, file = files[0]
+                    await bot.send_document(chat_id, file, caption=f"Вариант {number}/{n_variants}")
+                else:
+                    await bot.send_media_group(chat_id, [
+                        InputMediaDocument(media=file, caption=f"Вариант {number}/{n_variants}")
+                        for number, file in files
+                    ])
+            sent += len(files)
+            await job_queue.save_progress(job, sent)
+
+        # Прогресс правим в фоне: правки ждут лимита чата и схлопываются, не задерживая варианты
+        progress_edits: list[asyncio.Task] = []
+
+        def show_progress(done: int):
+            progress_edits.append(asyncio.create_task(bot.edit_message_text(
+                f"Шаг 2/2: Генерирую сцены и совмещаю товар (готово {done}/{n_variants})...",
+                chat_id=chat_id, message_id=msg.message_id)))
+
+        show_progress(sent)
+        tasks = [asyncio.create_task(render_variant()) for _ in range(remaining)]
+        ready: list[bytes] = []
+        collected: set[asyncio.Task] = set()
+        try:
+            # Прогресс считаем по мере готовности, а не в порядке запуска
+            pending = set(tasks)
+            while pending:
+                finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    collected.add(task)
+                    ready.append(task.result())
+                    if not SEND_AS_ALBUM:
+                        await deliver(ready)
+                        ready = []
+                    done = sent + len(ready)
+                    if done < n_variants:
+                        show_progress(done)
+        except Exception:
+            # Вариант упал: уже готовые всё равно отправляем и сохраняем прогресс,
+            # иначе повтор задачи сгенерирует их заново (это оплаченные генерации).
+            # Готовыми могут быть и задачи, до которых цикл ещё не дошёл
+            for task in tasks:
+                if task in collected or not task.done():
+                    task.cancel()
+                elif not task.cancelled() and task.exception() is None:
+                    ready.append(task.result())
+            if ready:
+                try:
+                    await deliver(ready)
+                except Exception:
+                    logging.exception(f"Не удалось отправить готовые варианты в чат {chat_id}")
+            raise
+        finally:
+            for task in tasks:
+                task.cancel()
+            for edit in await asyncio.gather(*progress_edits, return_exceptions=True):
+                if isinstance(edit, Exception):
+                    logging.warning(f"Не удалось обновить прогресс в чате {chat_id}: {edit}")
+        if ready:
+            # Все варианты одним альбомом: один запрос к Telegram вместо n
+            await deliver(ready)
+    finally:
+        # И при сбое: повтор пришлёт своё сообщение о прогрессе, старое не должно висеть в чате
+        try:
+            await msg.delete()
+        except Exception as e:
+            logging.warning(f"Не удалось удалить сообщение о прогрессе в чате {chat_id}: {e}")
+
+
+def job_fsm(job: Job) -> FSMContext:
+    return dp.fsm.get_context(bot=bot, chat_id=job.chat_id, user_id=job.payload["user_id"])
+
+
+async def process_job(job: Job, worker_id: str):
+    queue_wait = time.time() - job.created_at
+    metrics.QUEUE_WAIT_SECONDS.observe(queue_wait)
+    logging.info(f"[{worker_id}] Задача #{job.id}: попытка {job.attempts}/{job.max_attempts}, "
+                 f"ждала в очереди {queue_wait:.1f} с")
+
+    retry = True
+    if job.attempts > job.max_attempts:
+        # Воркер умирал на каждой попытке — больше не пробуем
+        error = "превышено число попыток"
+    else:
+        async def heartbeat():
+            while True:
+                await asyncio.sleep(JOB_VISIBILITY_TIMEOUT / 3)
+                await job_queue.heartbeat(job, worker_id, JOB_VISIBILITY_TIMEOUT)
+
+        hb = asyncio.create_task(heartbeat())
+        try:
+            with metrics.job_trace(job.id, log=METRICS_JOB_TRACE):
+                await run_generation(job)
+            await job_queue.complete(job)
+            metrics.JOBS_TOTAL.labels("done").inc()
+            await bot.send_message(job.chat_id, "✅ Готово!", reply_markup=START_KB)
+            await job_fsm(job).set_state(GenStates.waiting_start)
+            return
+        except asyncio.CancelledError:
+            # Воркер останавливают (деплой): задачу сразу возвращаем в очередь,
+            # а не ждём JOB_VISIBILITY_TIMEOUT
+            logging.info(f"Задача #{job.id} прервана остановкой воркера, возвращаю в очередь")
+            await job_queue.release(job, worker_id)
+            raise
+        except PermanentError as e:
+            logging.warning(f"Задача #{job.id} не может быть выполнена: {e}")
+            error, retry = str(e), False
+        except Exception as e:
+            logging.exception(f"Ошибка при генерации (задача #{job.id})")
+            error = str(e)
+        finally:
+            hb.cancel()
+
+    if await job_queue.fail(job, error, retry):
+        metrics.JOBS_TOTAL.labels("retry").inc()
+        logging.info(f"Задача #{job.id} будет повторена")
+        return
+    metrics.JOBS_TOTAL.labels("failed").inc()
+    await bot.send_message(job.chat_id, f"Что-то пошло не так 😥\nОшибка: {error}\n\nПопробуй ещё раз или начни с /start.")
+    await job_fsm(job).set_state(GenStates.waiting_photo) # Возвращаем на шаг отправки фото
+
+
+async def generation_worker(worker_id: str):
+    """Цикл воркера: забрать задачу, выполнить, повторить."""
+    logging.info(f"-> Воркер {worker_id} запущен")
+    while True:
+        try:
+            job = await job_queue.claim(worker_id, JOB_VISIBILITY_TIMEOUT)
+        except Exception:
+            logging.exception(f"[{worker_id}] Не удалось забрать задачу из очереди")
+            job = None
+        if job is None:
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+            continue
+        try:
+            await process_job(job, worker_id)
+        except Exception:
+            logging.exception(f"[{worker_id}] Сбой обработки задачи #{job.id}")
+
+
+def start_workers(count: int) -> list[asyncio.Task]:
+    prefix = f"{socket.gethostname()}:{os.getpid()}"
+    return [asyncio.create_task(generation_worker(f"{prefix}:{i}")) for i in range(count)]
+
+
+async def stop_workers(tasks: list[asyncio.Task]):
+    # Прерванные задачи process_job сразу возвращает в очередь (job_queue.release)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def start_pipeline():
+    """Лёгкие ресурсы конвейера — общие для веб-процесса и отдельных воркеров.
+
+    Тяжёлая часть (imaging, процессы пула, модель вырезки) — в warm_up.
+    """
+    await open_http_session()
+    await cutout_cache.start()
+    # Соединения с БД — только здесь, не при импорте (см. db.py)
+    await job_queue.db.open()
+    await job_queue.setup()
+    if isinstance(storage, SQLStorage):
+        await storage.db.open()
+        await storage.setup()
+    await job_queue.purge(JOB_RETENTION)
+
+
+async def warm_up():
+    """Импорт imaging, запуск и прогрев пулов обработки, загрузка модели вырезки.
+
+    Веб-процесс выполняет его фоном, уже заняв порт: до окончания /ready отвечает 503,
+    а встроенные воркеры не берут задачи, так что первый пользователь не платит за прогрев.
+    """
+    with metrics.startup_phase("imaging_import"):
+        # LazyLoader выполняет модуль при первом обращении к атрибуту — делаем это в потоке
+        await asyncio.to_thread(getattr, imaging, "warm_up")
+    start_imaging_pools()
+    with metrics.startup_phase("imaging_pools"):
+        # По задаче на процесс: пул запускает процессы по мере поступления задач
+        loop = asyncio.get_running_loop()
+        executors = [thread_pool] + [process_pool] * (IMAGING_PROCESSES if process_pool is not None else 0)
+        await asyncio.gather(*(loop.run_in_executor(executor, imaging.warm_up) for executor in executors))
+    with metrics.startup_phase("cutout_backend"):
+        await cutout_backend.start()
+    if bg_pool is not None:
+        await bg_pool.start(prefill=preset_pool_keys() if BG_POOL_PREFILL else ())
+
+
+async def stop_pipeline():
+    if bg_pool is not None:
+        await bg_pool.close()
+    await close_http_session()
+    stop_imaging_pools()
+    await cutout_backend.close()
+    logging.info(f"-> Кэш вырезок: {cutout_cache.stats()}")
+    job_queue.db.close()
+    await storage.close()
+
+
+# === Вебхук и функции старта/остановки ===
+WEBHOOK_PATH = f"/webhook/{BOT_TOKEN}"
+BASE_URL = os.getenv("WEBHOOK_BASE_URL") or os.getenv("RENDER_EXTERNAL_URL")
+if not BASE_URL:
+    raise RuntimeError("WEBHOOK_BASE_URL or RENDER_EXTERNAL_URL environment variable is not set!")
+WEBHOOK_URL = BASE_URL.rstrip('/') + WEBHOOK_PATH
+
+routes = web.RouteTableDef()
+
+@routes.post(WEBHOOK_PATH)
+async def telegram_webhook(request: web.Request):
+    try:
+        data = await request.json()
+        update = types.Update.model_validate(data)
+        await dp.feed_update(bot, update)
+        return web.Response(text="OK")
+    except Exception as e:
+        logging.exception("Webhook handling error")
+        return web.Response(status=500, text=str(e))
+
+# Метрики Prometheus
+@routes.get("/metrics")
+async def metrics_endpoint(request: web.Request):
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+# Liveness: процесс жив и event loop отвечает
+@routes.get("/health")
+async def health_check(request: web.Request):
+    return web.Response(text="OK")
+
+# Readiness (healthcheck Railway): прогрев завершён, воркеры работают
+@routes.get("/ready")
+async def readiness_check(request: web.Request):
+    task = request.app["warm_up"]
+    if not task.done():
+        return web.Response(status=503, text="warming up")
+    if task.cancelled() or task.exception() is not None:
+        return web.Response(status=503, text="warm-up failed")
+    return web.Response(text="OK")
+
+async def warm_up_and_start_workers(app: web.Application):
+    try:
+        with metrics.startup_phase("warm_up"):
+            await warm_up()
+    except Exception:
+        logging.exception("Прогрев не удался, /ready отвечает 503")
+        raise
+    app["workers"].extend(start_workers(EMBEDDED_WORKERS))
+    metrics.startup_done("ready", time.perf_counter() - IMPORT_STARTED)
+
+async def on_startup(app: web.Application):
+    logging.info("-> Выполняется on_startup...")
+    await start_pipeline()
+    # Тяжёлый прогрев — фоном: aiohttp занимает порт только после on_startup
+    app["workers"] = []
+    app["warm_up"] = asyncio.create_task(warm_up_and_start_workers(app))
+    # Реплик несколько: вебхук общий, ставим его только если он другой, и не сбрасываем
+    # накопившиеся обновления — их доставят этой или соседней реплике
+    info = await bot.get_webhook_info()
+    if info.url != WEBHOOK_URL:
+        await bot.set_webhook(WEBHOOK_URL)
+        logging.info(f"✔ Вебхук успешно установлен: {WEBHOOK_URL}")
+    else:
+        logging.info(f"✔ Вебхук уже установлен: {WEBHOOK_URL}")
+    
+async def on_shutdown(app: web.Application):
+    logging.info("-> Выполняется on_shutdown...")
+    # Вебхук не удаляем: остальные реплики продолжают принимать обновления
+    app["warm_up"].cancel()
+    await asyncio.gather(app["warm_up"], return_exceptions=True)
+    await stop_workers(app["workers"])
+    await stop_pipeline()
+    await bot.session.close()
+    logging.info("-> Бот остановлен.")
+
+def create_app() -> web.Application:
+    app = web.Application()
+    # Вебхук обрабатывает telegram_webhook (routes); второй обработчик на тот же путь не нужен
+    app.add_routes(routes)
+
+    # Регистрируем хэндлеры для старта и остановки
+    app.on_startup.append(on_startup) # <-- Передаем ссылку на функцию
+    app.on_shutdown.append(on_shutdown) # <-- Передаем ссылку на функцию
+    return app
+
+# Основная функция запуска приложения
+def main():
+    logging.info("-> Запуск main()...")
+    app = create_app()
+
+    port = int(os.environ.get("PORT", 8000))
+    logging.info(f"-> Запуск веб-сервера на порту {port}")
+    web.run_app(app, host="0.0.0.0", port=port)
+    logging.info("-> Настройка веб-сервера завершена.")
+
+# Отдельный процесс-воркер: python3 main_bot.py worker
+async def worker_main():
+    if not isinstance(storage, SQLStorage):
+        # Состояния диалогов веб-процесса воркеру видны только через общую БД
+        raise RuntimeError("Отдельному воркеру нужно общее хранилище FSM: задайте FSM_STORAGE_URL или DATABASE_URL")
+    logging.info(f"-> Запуск воркера генерации ({WORKER_CONCURRENCY} задач одновременно)...")
+    await start_pipeline()
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT)
+    with metrics.startup_phase("warm_up"):
+        await warm_up()
+    tasks = start_workers(WORKER_CONCURRENCY)
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        await stop_workers(tasks)
+        await stop_pipeline()
+        await bot.session.close()
+
+metrics.startup_done("import", time.perf_counter() - IMPORT_STARTED)
+
+def run(argv: list[str]):
+    """Точка входа (см. main_bot.py): веб-процесс или, с аргументом worker, отдельный воркер."""
+    try:
+        if argv[:1] == ["worker"]:
+            asyncio.run(worker_main())
+        else:
+            main()
+    except Exception as e:
+        logging.error(f"FATAL ERROR: Приложение бота завершилось неожиданно: {e}", exc_info=True)
+        time.sleep(10)
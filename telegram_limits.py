@@ -0,0 +1,179 @@
+# telegram_limits.py — исходящие запросы к Bot API в пределах лимитов Telegram.
+#
+# Middleware сессии бота: общий token bucket (~30 сообщений/с на бота) и bucket
+# на каждый чат (~1 сообщение/с с небольшим запасом). 429 с retry_after ставит
+# на паузу только свой чат — остальные продолжают работать.
+#
+# Правки одного сообщения (editMessageText) идут строго по очереди и схлопываются:
+# пока правка ждёт очереди, более новые заменяют её текст, а правки, которые ничего
+# не меняют, не отправляются вовсе.
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Callable, Optional, Union
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import DeleteMessage, EditMessageText, SendMessage, TelegramMethod
+from aiogram.types import Message
+
+import metrics
+
+ChatId = Union[int, str]
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()  # ожидающие получают токены по очереди
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Flood control: новых запросов не выдавать seconds секунд."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst and now >= self.paused_until and not self._lock.locked()
+
+
+class _EditState:
+    """Очередь правок одного сообщения и последний известный его текст."""
+
+    def __init__(self, text: Optional[str] = None):
+        self.lock = asyncio.Lock()
+        self.text = text
+        self.latest: Optional[EditMessageText] = None
+        self.version = 0  # номер последней поставленной правки
+        self.sent = 0  # номер правки, текст которой уже в Telegram
+
+
+class TelegramRateLimiter(BaseRequestMiddleware):
+    def __init__(self, global_rate: float = 25, chat_rate: float = 1, chat_burst: float = 3,
+                 max_retries: int = 5, max_tracked: int = 10000):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_tracked = max_tracked
+        self._chats: dict[ChatId, TokenBucket] = {}
+        self._messages: OrderedDict[tuple[ChatId, int], _EditState] = OrderedDict()
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            # getFile, setWebhook и т.п. — не сообщения, лимиты на них не распространяются
+            return await make_request(bot, method)
+        if isinstance(method, EditMessageText) and method.message_id is not None:
+            return await self._edit(make_request, bot, method, chat_id)
+
+        result = await self._request(make_request, bot, method, chat_id)
+        if isinstance(method, SendMessage) and isinstance(result, Message):
+            self._message(chat_id, result.message_id).text = result.text
+        elif isinstance(method, DeleteMessage):
+            self._messages.pop((chat_id, method.message_id), None)
+        return result
+
+    # ---- лимиты ----
+
+    def _chat_bucket(self, chat_id: ChatId) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.max_tracked:
+                now = time.monotonic()
+                self._chats = {k: b for k, b in self._chats.items() if not b.idle(now)}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _request(self, make_request, bot, method, chat_id: ChatId,
+                       refresh: Optional[Callable[[], Optional[TelegramMethod]]] = None):
+        """refresh — для правок: перед каждой попыткой возвращает актуальный запрос
+        или None, если отправлять уже нечего."""
+        bucket = self._chat_bucket(chat_id)
+        for attempt in range(1, self.max_retries + 1):
+            # Сначала токен чата, потом общий — чтобы не держать общий в ожидании своего
+            with metrics.stage("telegram_rate_wait"):
+                await bucket.acquire()
+                await self.global_bucket.acquire()
+            if refresh is not None:
+                # Пока ждали токен или паузу после 429, текст мог обновиться
+                method = refresh()
+                if method is None:
+                    return True
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                logging.warning(f"Telegram flood control в чате {chat_id}: пауза {e.retry_after} с "
+                                f"({type(method).__name__}, попытка {attempt}/{self.max_retries})")
+                bucket.pause(e.retry_after)
+
+    # ---- правки сообщений ----
+
+    def _message(self, chat_id: ChatId, message_id: int) -> _EditState:
+        key = (chat_id, message_id)
+        state = self._messages.get(key)
+        if state is None:
+            state = self._messages[key] = _EditState()
+            while len(self._messages) > self.max_tracked:
+                old_key, old = next(iter(self._messages.items()))
+                if old.lock.locked():
+                    break
+                del self._messages[old_key]
+        else:
+            self._messages.move_to_end(key)
+        return state
+
+    async def _edit(self, make_request, bot, method: EditMessageText, chat_id: ChatId):
+        state = self._message(chat_id, method.message_id)
+        state.version += 1
+        state.latest = method
+        version = state.version
+
+        async with state.lock:
+            if state.sent >= version:
+                # Пока правка ждала, ушёл более новый текст
+                metrics.TELEGRAM_EDITS_SKIPPED.labels("coalesced").inc()
+                return True
+            sending, sending_version = state.latest, state.version
+
+            def refresh() -> Optional[EditMessageText]:
+                nonlocal sending, sending_version
+                sending, sending_version = state.latest, state.version
+                if sending.reply_markup is None and sending.text == state.text:
+                    metrics.TELEGRAM_EDITS_SKIPPED.labels("unchanged").inc()
+                    state.sent = sending_version
+                    return None
+                return sending
+
+            if refresh() is None:
+                return True
+            result = await self._request(make_request, bot, sending, chat_id, refresh)
+            # Пока шёл запрос, могли прийти новые правки: они ждут на lock
+            state.sent = max(state.sent, sending_version)
+            state.text = sending.text
+            return result
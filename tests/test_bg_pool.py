@@ -0,0 +1,47 @@
+import asyncio
+import itertools
+
+from bg_pool import BackgroundPool
+
+_serial = itertools.count()
+
+
+async def _generate(prompt: str, size: str) -> bytes:
+    return f"{size}:{prompt}:{next(_serial)}".encode()
+
+
+def test_requested_key_is_refilled_and_taken_once(tmp_path):
+    async def scenario():
+        pool = BackgroundPool(tmp_path, depth=2, max_uses=1, ttl=3600, generate=_generate, scan_interval=30)
+        other = BackgroundPool(tmp_path, depth=2, max_uses=1, ttl=3600, generate=_generate, scan_interval=30)
+        await pool.start()
+        await other.start()
+        assert await pool.take("лофт", "1024x1024") is None  # первый запрос только регистрирует ключ
+        for _ in range(100):
+            if pool.stats()["backgrounds"] + other.stats()["backgrounds"] >= 2:
+                break
+            await asyncio.sleep(0.01)
+        taken = [await p.take("лофт", "1024x1024") for p in (pool, other)]
+        await pool.close()
+        await other.close()
+        return taken
+
+    first, second = asyncio.run(scenario())
+    assert first.startswith("1024x1024:лофт:".encode())
+    assert second.startswith("1024x1024:лофт:".encode())
+    assert first != second  # max_uses=1: каждый фон выдан одному процессу один раз
+
+
+def test_close_right_after_take_does_not_hang(tmp_path):
+    async def scenario():
+        for i in range(20):
+            pool = BackgroundPool(tmp_path / str(i), depth=1, max_uses=1, ttl=3600,
+                                  generate=_generate, scan_interval=30)
+            await pool.start()
+            await asyncio.sleep(0.01 if i % 2 else 0)
+            await pool.take("студия", "1024x1024")
+            await asyncio.sleep(0)
+            # Python 3.10: wait_for в цикле догенерации терял отмену, close() ждал вечно
+            await asyncio.wait_for(asyncio.shield(pool.close()), timeout=2)
+
+    asyncio.run(scenario())
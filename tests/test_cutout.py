@@ -0,0 +1,128 @@
+import asyncio
+import sys
+import types
+
+import pytest
+
+from cutout import CutoutBackend, FallbackBackend, RembgBackend
+
+
+class FakeSession:
+    """Сессия rembg: запоминает модель и настройки onnxruntime."""
+
+    def __init__(self, model: str, sess_opts):
+        self.model = model
+        self.sess_opts = sess_opts
+
+    @classmethod
+    def name(cls) -> str:
+        return cls.model_name
+
+
+class U2net(FakeSession):
+    model_name = "u2net"
+
+
+class Isnet(FakeSession):
+    model_name = "isnet-general-use"
+
+
+@pytest.fixture
+def fake_rembg(monkeypatch):
+    """rembg и onnxruntime без модели: сессии — заглушки, remove отдаёт байты с пометкой сессии."""
+    calls = []
+
+    def remove(image_bytes: bytes, session) -> bytes:
+        calls.append(session)
+        return f"{session.model}:".encode() + image_bytes
+
+    rembg = types.ModuleType("rembg")
+    rembg.remove = remove
+    sessions = types.ModuleType("rembg.sessions")
+    sessions.sessions_class = [U2net, Isnet]
+    ort = types.ModuleType("onnxruntime")
+    ort.SessionOptions = types.SimpleNamespace
+    monkeypatch.setitem(sys.modules, "rembg", rembg)
+    monkeypatch.setitem(sys.modules, "rembg.sessions", sessions)
+    monkeypatch.setitem(sys.modules, "onnxruntime", ort)
+    return calls
+
+
+def test_rembg_session_is_loaded_once_and_reused(fake_rembg):
+    async def scenario():
+        backend = RembgBackend(model="isnet-general-use", threads=2)
+        with pytest.raises(RuntimeError):
+            await backend.remove(b"jpg")  # до прогрева модели нет
+        await backend.start()
+        await backend.start()
+        results = [await backend.remove(b"jpg") for _ in range(2)]
+        await backend.close()
+        return backend, results
+
+    backend, results = asyncio.run(scenario())
+    assert results == [b"isnet-general-use:jpg"] * 2
+    # Прогрев и оба запроса — одна и та же сессия с настройками потоков
+    assert len({id(s) for s in fake_rembg}) == 1
+    session = fake_rembg[0]
+    assert isinstance(session, Isnet)
+    assert (session.sess_opts.intra_op_num_threads, session.sess_opts.inter_op_num_threads) == (2, 1)
+    assert backend._session is None
+
+
+def test_unknown_rembg_model_is_a_config_error(fake_rembg):
+    backend = RembgBackend(model="u2netp-typo")
+    with pytest.raises(RuntimeError, match="u2netp-typo.*isnet-general-use, u2net"):
+        asyncio.run(backend.start())
+    asyncio.run(backend.close())
+
+
+class StubBackend(CutoutBackend):
+    def __init__(self, name: str, fail_start: bool = False, fail_remove: bool = False):
+        self.name = name
+        self.fail_start = fail_start
+        self.fail_remove = fail_remove
+        self.events = []
+
+    async def start(self):
+        self.events.append("start")
+        if self.fail_start:
+            raise RuntimeError("модель не загрузилась")
+
+    async def close(self):
+        self.events.append("close")
+
+    async def remove(self, image_bytes: bytes) -> bytes:
+        self.events.append("remove")
+        if self.fail_remove:
+            raise RuntimeError("не справился")
+        return f"{self.name}:".encode() + image_bytes
+
+
+def test_fallback_is_used_when_primary_fails():
+    primary, fallback = StubBackend("local", fail_remove=True), StubBackend("pixelcut")
+    backend = FallbackBackend(primary, fallback)
+    assert backend.name == "local+pixelcut"
+
+    async def scenario():
+        await backend.start()
+        result = await backend.remove(b"jpg")
+        await backend.close()
+        return result
+
+    assert asyncio.run(scenario()) == b"pixelcut:jpg"
+    assert primary.events == ["start", "remove", "close"]
+    assert fallback.events == ["start", "remove", "close"]
+
+
+def test_fallback_starts_even_if_primary_does_not():
+    primary, fallback = StubBackend("local", fail_start=True), StubBackend("pixelcut")
+    # Не загрузилась локальная модель — бот всё равно стартует на запасном бэкенде
+    asyncio.run(FallbackBackend(primary, fallback).start())
+    assert primary.events == ["start"]
+    assert fallback.events == ["start"]
+
+
+def test_fallback_error_propagates():
+    backend = FallbackBackend(StubBackend("local", fail_remove=True), StubBackend("pixelcut", fail_remove=True))
+    with pytest.raises(RuntimeError, match="не справился"):
+        asyncio.run(backend.remove(b"jpg"))
@@ -0,0 +1,99 @@
+import asyncio
+import os
+import time
+
+from cutout_cache import CutoutCache, cache_key
+
+
+def _cache(directory, mem_max_bytes=1000, disk_max_bytes=1000, ttl=3600) -> CutoutCache:
+    cache = CutoutCache(directory, mem_max_bytes=mem_max_bytes, disk_max_bytes=disk_max_bytes, ttl=ttl)
+    asyncio.run(cache.start())
+    return cache
+
+
+def _age(cache: CutoutCache, key: str, seconds: float):
+    path = cache._path(key)
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+
+def test_cache_key_depends_on_every_part():
+    assert cache_key("pixelcut", "abc") == cache_key("pixelcut", "abc")
+    assert cache_key("pixelcut", "abc") != cache_key("local", "abc")
+    assert cache_key("ab", "c") != cache_key("a", "bc")
+
+
+def test_memory_lru_evicts_least_recently_used():
+    async def scenario():
+        cache = CutoutCache(None, mem_max_bytes=10, disk_max_bytes=0, ttl=3600)
+        await cache.put("a", b"aaaa")
+        await cache.put("b", b"bbbb")
+        await cache.get("a")  # a теперь свежее b
+        await cache.put("c", b"cccc")
+        await cache.put("big", b"x" * 11)  # больше всего лимита — в память не кладётся
+        return cache, [await cache.get(k) for k in ("a", "b", "c", "big")]
+
+    cache, values = asyncio.run(scenario())
+    assert values == [b"aaaa", None, b"cccc", None]
+    assert cache.stats()["memory_bytes"] == 8
+
+
+def test_hit_and_miss_counters(tmp_path):
+    cache = _cache(tmp_path)
+
+    async def scenario():
+        assert await cache.get("k") is None
+        await cache.put("k", b"png")
+        assert await cache.get("k") == b"png"
+        # Другой процесс (пустая память) находит вырезку на диске
+        other = CutoutCache(tmp_path, mem_max_bytes=1000, disk_max_bytes=1000, ttl=3600)
+        await other.start()
+        assert await other.get("k") == b"png"
+        assert await other.get("k") == b"png"
+        return other
+
+    other = asyncio.run(scenario())
+    stats = cache.stats()
+    assert (stats["hits_memory"], stats["hits_disk"], stats["misses"], stats["hit_ratio"]) == (1, 0, 1, 0.5)
+    assert (stats["memory_bytes"], stats["disk_bytes"]) == (3, 3)
+    assert (other.hits_memory, other.hits_disk, other.misses) == (1, 1, 0)
+    assert other.stats()["hit_ratio"] == 1.0
+
+
+def test_disk_size_cap_removes_oldest_files(tmp_path):
+    cache = _cache(tmp_path, mem_max_bytes=0, disk_max_bytes=10)
+
+    async def scenario():
+        for age, key in ((30, "old"), (20, "mid")):
+            await cache.put(key, b"1234")
+            _age(cache, key, age)
+        await cache.put("new", b"1234")  # 12 байт > 10 — самый старый файл удаляется
+
+    asyncio.run(scenario())
+    assert not cache._path("old").exists()
+    assert cache._path("mid").exists() and cache._path("new").exists()
+    assert cache.stats()["disk_bytes"] == 8
+
+
+def test_rewriting_a_key_counts_its_size_once(tmp_path):
+    cache = _cache(tmp_path, mem_max_bytes=0)
+
+    async def scenario():
+        for _ in range(3):
+            await cache.put("k", b"1234")
+        await cache.put("k", b"12")
+
+    asyncio.run(scenario())
+    assert cache.stats()["disk_bytes"] == 2
+
+
+def test_expired_files_are_misses_and_swept_on_start(tmp_path):
+    cache = _cache(tmp_path, mem_max_bytes=0, ttl=60)
+    asyncio.run(cache.put("k", b"png"))
+    _age(cache, "k", 120)
+    assert asyncio.run(cache.get("k")) is None
+    assert cache.misses == 1
+
+    restarted = _cache(tmp_path, ttl=60)
+    assert not restarted._path("k").exists()
+    assert restarted.stats()["disk_bytes"] == 0
@@ -0,0 +1,132 @@
+import asyncio
+
+import pytest
+from aiogram.fsm.storage.base import StorageKey
+
+from db import Database
+from fsm_storage import SQLStorage
+
+
+def _key(chat_id: int) -> StorageKey:
+    return StorageKey(bot_id=1, chat_id=chat_id, user_id=chat_id)
+
+
+def _rows(db: Database) -> dict:
+    def select(cur):
+        cur.execute("SELECT key, state, data FROM fsm_state")
+        return {row[0]: (row[1], row[2]) for row in cur.fetchall()}
+
+    return db.run_sync(select)
+
+
+@pytest.fixture
+def url(tmp_path):
+    return f"sqlite:///{tmp_path / 'fsm.sqlite3'}"
+
+
+def test_data_is_buffered_and_written_in_one_batch(url):
+    async def scenario():
+        # Фоновый сброс не мешает: пишем только явным flush()
+        storage = SQLStorage(Database(url), ttl=3600, flush_interval=3600)
+        await storage.setup()
+        writes = 0
+        run = storage.db.run
+
+        async def counting_run(fn):
+            nonlocal writes
+            writes += 1
+            return await run(fn)
+
+        storage.db.run = counting_run
+        for chat_id in (1, 2, 3):
+            await storage.update_data(_key(chat_id), {"n": chat_id})
+        await storage.update_data(_key(1), {"style": "лофт"})
+        assert writes == 3  # update_data читает ещё не записанный ключ из БД
+        assert _rows(storage.db) == {}
+        assert await storage.get_data(_key(1)) == {"n": 1, "style": "лофт"}
+
+        writes = 0
+        await storage.flush()
+        assert writes == 1
+        assert len(_rows(storage.db)) == 3
+        await storage.close()
+
+    asyncio.run(scenario())
+
+
+def test_set_state_is_visible_to_another_replica_immediately(url):
+    async def scenario():
+        web = SQLStorage(Database(url), ttl=3600, flush_interval=3600)
+        worker = SQLStorage(Database(url), ttl=3600, flush_interval=3600)
+        await web.setup()
+        await worker.setup()
+        await web.update_data(_key(7), {"file_id": "abc"})
+        await web.set_state(_key(7), "GenStates:generating")
+        assert await worker.get_state(_key(7)) == "GenStates:generating"
+        assert await worker.get_data(_key(7)) == {"file_id": "abc"}
+        await web.close()
+        await worker.close()
+
+    asyncio.run(scenario())
+
+
+def test_failed_flush_keeps_changes_without_overwriting_newer_ones(url):
+    async def scenario():
+        storage = SQLStorage(Database(url), ttl=3600, flush_interval=3600)
+        await storage.setup()
+        await storage.set_data(_key(1), {"v": 1})
+        await storage.set_data(_key(2), {"v": 1})
+
+        run = storage.db.run
+
+        async def failing_run(fn):
+            raise ConnectionError("БД недоступна")
+
+        storage.db.run = failing_run
+        with pytest.raises(ConnectionError):
+            await storage.flush()
+        # Пока запись не удалась, ключ 1 успели изменить ещё раз
+        await storage.set_data(_key(1), {"v": 2})
+
+        storage.db.run = run
+        await storage.flush()
+        rows = _rows(storage.db)
+        assert rows[storage.key_builder.build(_key(1))][1] == '{"v": 2}'
+        assert rows[storage.key_builder.build(_key(2))][1] == '{"v": 1}'
+        await storage.close()
+
+    asyncio.run(scenario())
+
+
+def test_background_task_flushes_pending_changes(url):
+    async def scenario():
+        storage = SQLStorage(Database(url), ttl=3600, flush_interval=0.01)
+        await storage.setup()
+        await storage.set_data(_key(1), {"v": 1})
+        for _ in range(100):
+            if _rows(storage.db):
+                break
+            await asyncio.sleep(0.01)
+        assert len(_rows(storage.db)) == 1
+        await storage.close()
+
+    asyncio.run(scenario())
+
+
+def test_expired_sessions_read_as_empty_and_are_purged(url):
+    async def scenario():
+        storage = SQLStorage(Database(url), ttl=0.2, flush_interval=3600)
+        await storage.setup()
+        await storage.set_data(_key(1), {"v": 1})
+        await storage.set_state(_key(1), "GenStates:waiting_style")
+        assert await storage.get_state(_key(1)) == "GenStates:waiting_style"
+
+        await asyncio.sleep(0.3)
+        assert await storage.get_state(_key(1)) is None
+        assert await storage.get_data(_key(1)) == {}
+        assert len(_rows(storage.db)) == 1
+        await storage.purge()
+        assert _rows(storage.db) == {}
+        await storage.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,114 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import imaging
+
+
+def _png(img: Image.Image) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+@pytest.mark.parametrize("mode", ["P", "1", "I;16", "LA", "RGBA"])
+def test_normalize_large_image_any_mode(mode):
+    # 4100x3000 при max_edge=2048 идёт через reduce(2), который умеет не все режимы
+    source = _png(Image.new(mode, (4100, 3000)))
+    with Image.open(io.BytesIO(imaging.normalize_input(source, 2048))) as out:
+        assert out.format == "JPEG"
+        assert out.mode == "RGB"
+        assert max(out.size) <= 2048
+
+
+def test_normalize_small_jpeg_passes_through():
+    buf = io.BytesIO()
+    Image.new("RGB", (640, 480), (200, 10, 10)).save(buf, format="JPEG")
+    assert imaging.normalize_input(buf.getvalue(), 2048) == buf.getvalue()
+
+
+def test_normalize_path_matches_bytes(tmp_path):
+    source = _png(Image.new("P", (4100, 3000)))
+    path = tmp_path / "upload.png"
+    path.write_bytes(source)
+    assert imaging.normalize_input(path, 2048) == imaging.normalize_input(source, 2048)
+
+
+def test_studio_shadow_fades_below_trimmed_subject():
+    # Вырезка обрезана по альфе (trim_transparent): тени некуда растекаться внутри самого объекта
+    subject = Image.new("RGBA", (400, 600), (0, 0, 0, 0))
+    subject.paste((30, 90, 200, 255), (100, 150, 300, 450))
+    trimmed = imaging.trim_transparent(_png(subject))
+    assert Image.open(io.BytesIO(trimmed)).size == (200, 300)
+
+    out = np.asarray(imaging.compose_subject_on_bg(trimmed, Image.new("RGB", (1024, 1024), (240, 240, 240))))
+    bottom = 1024 - int(1024 * 0.05)  # нижний край объекта
+    column = out[bottom:bottom + imaging.SHADOW_OFFSET[1] + imaging.SHADOW_PAD, 512, 0].astype(int)
+    assert column[0] < 100  # под объектом — тень
+    assert column[-1] >= 235  # и к краю поля она сходит на нет
+    assert np.diff(column).min() >= -2  # светлеет плавно, без жёсткой полосы
+    assert np.diff(column).max() <= 40
+
+
+@pytest.mark.parametrize("size", [(1024, 1024), (1024, 1792), (1792, 1024)])
+def test_studio_compose_matches_pil_reference(size):
+    # Эталон — прежняя реализация на PIL (bench_compose); вырезка с полями, как от Pixelcut
+    from bench_compose import compose_reference, make_background, make_subject
+
+    subject, bg = make_subject(), make_background(size)
+    ref = np.asarray(compose_reference(subject, bg.convert("RGBA")).convert("RGB"), dtype=np.int16)
+    new = np.asarray(imaging.compose_subject_on_bg(subject, bg), dtype=np.int16)
+    diff = np.abs(ref - new)
+    assert diff.mean() <= 1.0
+    assert np.percentile(diff, 99) <= 4
+
+
+def _subject(size=(400, 600), box=(100, 150, 300, 450), color=(30, 90, 200, 255)) -> Image.Image:
+    img = Image.new("RGBA", size, (0, 0, 0, 0))
+    img.paste(color, box)
+    return img
+
+
+def test_trim_transparent_crops_to_alpha_box():
+    subject = _subject()
+    subject.putpixel((5, 5), (255, 255, 255, 6))  # шум по краю кадра не расширяет рамку
+    with Image.open(io.BytesIO(imaging.trim_transparent(_png(subject)))) as out:
+        assert out.size == (200, 300)
+        assert out.mode == "RGBA"
+        assert out.getpixel((0, 0)) == (30, 90, 200, 255)
+
+
+def test_trim_transparent_keeps_bytes_when_nothing_to_trim():
+    tight = _png(Image.new("RGBA", (50, 80), (30, 90, 200, 255)))
+    empty = _png(Image.new("RGBA", (50, 80), (0, 0, 0, 0)))
+    assert imaging.trim_transparent(tight) is tight
+    assert imaging.trim_transparent(empty) is empty
+
+
+def test_seamless_place_changes_only_the_window_around_subject():
+    back = Image.fromarray(np.random.default_rng(0).integers(0, 255, (600, 800, 3), dtype=np.uint8))
+    subject = _png(Image.new("RGBA", (100, 200), (30, 90, 200, 255)))
+    out = np.asarray(imaging.seamless_place(subject, back, 0.4, 400, 300)).astype(int)
+    changed = np.argwhere(np.abs(out - np.asarray(back).astype(int)).max(axis=2) > 0)
+    assert len(changed)
+    # Объект высотой 0.4 фона (240 px) по центру + SEAMLESS_PAD вокруг
+    (y0, x0), (y1, x1) = changed.min(axis=0), changed.max(axis=0)
+    pad = imaging.SEAMLESS_PAD
+    assert y0 >= 300 - 120 - pad and y1 < 300 + 120 + pad
+    assert x0 >= 400 - 60 - pad and x1 < 400 + 60 + pad
+
+
+def test_seamless_place_fits_large_subject_near_edge():
+    back = Image.new("RGB", (300, 200), (120, 130, 140))
+    subject = _png(Image.new("RGBA", (900, 1200), (30, 90, 200, 255)))
+    # Объект выше фона, центр у самого края — seamlessClone не должен падать
+    out = imaging.seamless_place(subject, back, 0.9, 5, 195)
+    assert out.size == back.size
+
+
+def test_seamless_place_with_empty_mask_returns_background():
+    back = Image.new("RGB", (300, 200), (120, 130, 140))
+    out = imaging.seamless_place(_png(Image.new("RGBA", (50, 50), (0, 0, 0, 0))), back, 0.4, 150, 100)
+    assert np.array_equal(np.asarray(out), np.asarray(back))
@@ -0,0 +1,136 @@
+import asyncio
+
+import pytest
+
+from db import Database
+from job_queue import JobQueue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = JobQueue(Database(f"sqlite:///{tmp_path / 'jobs.sqlite3'}"), max_attempts=2, retry_backoff=60)
+    asyncio.run(queue.setup())
+    return queue
+
+
+async def _drain(queue: JobQueue) -> list[int]:
+    order = []
+    while (job := await queue.claim("w1", visibility_timeout=60)) is not None:
+        order.append(job.payload["n"])
+        await queue.complete(job)
+    return order
+
+
+def test_chats_take_turns(queue):
+    async def scenario():
+        for n in (1, 2, 3):
+            await queue.enqueue(100, {"n": n})
+        await queue.enqueue(200, {"n": 4})
+        return await _drain(queue)
+
+    # Задача второго чата не ждёт, пока выполнится вся очередь первого
+    assert asyncio.run(scenario()) == [1, 4, 2, 3]
+
+
+def test_cost_weighs_against_the_chat(queue):
+    async def scenario():
+        await queue.enqueue(100, {"n": 1}, cost=4)
+        await queue.enqueue(200, {"n": 2})
+        await queue.enqueue(200, {"n": 3})
+        return await _drain(queue)
+
+    assert asyncio.run(scenario()) == [2, 3, 1]
+
+
+def test_priority_goes_first(queue):
+    async def scenario():
+        await queue.enqueue(100, {"n": 1})
+        await queue.enqueue(200, {"n": 2}, priority=1)
+        return await _drain(queue)
+
+    assert asyncio.run(scenario()) == [2, 1]
+
+
+def test_recently_finished_jobs_still_count(queue):
+    async def scenario():
+        await queue.enqueue(100, {"n": 1})
+        assert await _drain(queue) == [1]
+        await queue.enqueue(100, {"n": 2})
+        await queue.enqueue(200, {"n": 3})
+        return await _drain(queue)
+
+    assert asyncio.run(scenario()) == [3, 2]
+
+
+def test_position_follows_claim_order(queue):
+    async def scenario():
+        first = await queue.enqueue(100, {"n": 1})
+        second = await queue.enqueue(100, {"n": 2})
+        other = await queue.enqueue(200, {"n": 3})
+        assert [await queue.position(j) for j in (first, other, second)] == [1, 2, 3]
+
+        job = await queue.claim("w1", visibility_timeout=60)
+        assert job.id == first
+        assert await queue.position(first) is None
+        assert await queue.position(other) == 1
+        assert await queue.position(second) == 2
+
+    asyncio.run(scenario())
+
+
+def test_failed_job_is_retried_after_backoff(queue):
+    async def scenario():
+        job_id = await queue.enqueue(100, {"n": 1})
+        job = await queue.claim("w1", visibility_timeout=60)
+        await queue.save_progress(job, 2)
+        assert await queue.fail(job, "boom") is True
+        # Повтор — только после паузы
+        assert await queue.claim("w1", visibility_timeout=60) is None
+
+        await queue.db.run(lambda cur: cur.execute("UPDATE gen_jobs SET visible_at = 0"))
+        job = await queue.claim("w1", visibility_timeout=60)
+        assert (job.id, job.attempts, job.progress) == (job_id, 2, 2)
+        assert await queue.fail(job, "boom") is False
+        await queue.db.run(lambda cur: cur.execute("UPDATE gen_jobs SET visible_at = 0"))
+        assert await queue.claim("w1", visibility_timeout=60) is None
+
+    asyncio.run(scenario())
+
+
+def test_job_of_a_dead_worker_is_claimed_again(queue):
+    async def scenario():
+        job_id = await queue.enqueue(100, {"n": 1})
+        job = await queue.claim("w1", visibility_timeout=0)
+        assert job.id == job_id
+        # w1 не продлевал аренду — задачу забирает другой воркер
+        job = await queue.claim("w2", visibility_timeout=60)
+        assert (job.id, job.attempts) == (job_id, 2)
+        assert await queue.claim("w3", visibility_timeout=60) is None
+
+    asyncio.run(scenario())
+
+
+def test_permanent_failure_is_not_retried(queue):
+    async def scenario():
+        await queue.enqueue(100, {"n": 1})
+        job = await queue.claim("w1", visibility_timeout=60)
+        assert await queue.fail(job, "не изображение", retry=False) is False
+        await queue.db.run(lambda cur: cur.execute("UPDATE gen_jobs SET visible_at = 0"))
+        assert await queue.claim("w1", visibility_timeout=60) is None
+
+    asyncio.run(scenario())
+
+
+def test_released_job_is_claimed_again_at_once(queue):
+    async def scenario():
+        job_id = await queue.enqueue(100, {"n": 1})
+        job = await queue.claim("w1", visibility_timeout=300)
+        # Чужой воркер не может вернуть не свою задачу
+        await queue.release(job, "w2")
+        assert await queue.claim("w2", visibility_timeout=60) is None
+        # Остановка воркера: задача возвращается без ожидания таймаута и без потери попытки
+        await queue.release(job, "w1")
+        job = await queue.claim("w2", visibility_timeout=60)
+        assert (job.id, job.attempts) == (job_id, 1)
+
+    asyncio.run(scenario())
@@ -0,0 +1,97 @@
+import asyncio
+import time
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import EditMessageText, SendMessage
+
+from telegram_limits import TelegramRateLimiter
+
+
+class FakeTelegram:
+    """make_request для middleware: запоминает запросы, отвечает с задержкой и умеет 429."""
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.requests: list[tuple[float, object, str]] = []
+        self.flood: dict[object, float] = {}  # chat_id -> retry_after для следующего запроса
+
+    async def __call__(self, bot, method):
+        self.requests.append((time.monotonic(), method.chat_id, method.text))
+        retry_after = self.flood.pop(method.chat_id, None)
+        if retry_after is not None:
+            raise TelegramRetryAfter(method=method, message="Too Many Requests", retry_after=retry_after)
+        await asyncio.sleep(self.delay)
+        return True
+
+    def texts(self, chat_id=1) -> list[str]:
+        return [text for _, chat, text in self.requests if chat == chat_id]
+
+
+def _edit(text: str, chat_id=1) -> EditMessageText:
+    return EditMessageText(chat_id=chat_id, message_id=10, text=text)
+
+
+def test_queued_edits_collapse_into_the_latest():
+    async def scenario():
+        limiter, telegram = TelegramRateLimiter(chat_rate=100, chat_burst=100), FakeTelegram(delay=0.05)
+        first = asyncio.create_task(limiter(telegram, None, _edit("1/4")))
+        await asyncio.sleep(0.01)
+        rest = [asyncio.create_task(limiter(telegram, None, _edit(f"{n}/4"))) for n in (2, 3, 4)]
+        await asyncio.gather(first, *rest)
+        return telegram.texts()
+
+    assert asyncio.run(scenario()) == ["1/4", "4/4"]
+
+
+def test_unchanged_edit_is_not_sent():
+    async def scenario():
+        limiter, telegram = TelegramRateLimiter(chat_rate=100, chat_burst=100), FakeTelegram()
+        assert await limiter(telegram, None, _edit("готово 1/2")) is True
+        assert await limiter(telegram, None, _edit("готово 1/2")) is True
+        await limiter(telegram, None, _edit("готово 2/2"))
+        return telegram.texts()
+
+    assert asyncio.run(scenario()) == ["готово 1/2", "готово 2/2"]
+
+
+def test_chat_rate_limit():
+    async def scenario():
+        limiter, telegram = TelegramRateLimiter(chat_rate=20, chat_burst=1), FakeTelegram()
+        started = time.monotonic()
+        await asyncio.gather(*(limiter(telegram, None, SendMessage(chat_id=1, text=str(n))) for n in range(3)))
+        return time.monotonic() - started
+
+    # Первый — из запаса, ещё два — по 1/20 с
+    assert asyncio.run(scenario()) >= 0.09
+
+
+def test_flood_control_pauses_only_its_chat():
+    async def scenario():
+        limiter, telegram = TelegramRateLimiter(chat_rate=100, chat_burst=100), FakeTelegram()
+        telegram.flood[1] = 0.3
+        started = time.monotonic()
+        flooded = asyncio.create_task(limiter(telegram, None, SendMessage(chat_id=1, text="a")))
+        await asyncio.sleep(0.01)
+        await limiter(telegram, None, SendMessage(chat_id=2, text="b"))
+        other_done = time.monotonic() - started
+        await flooded
+        return other_done, [(round(t - started, 1), chat) for t, chat, _ in telegram.requests]
+
+    other_done, requests = asyncio.run(scenario())
+    assert other_done < 0.1
+    # Чат 1: первая попытка, 429, повтор не раньше retry_after; чат 2 прошёл сразу
+    assert requests == [(0.0, 1), (0.0, 2), (0.3, 1)]
+
+
+def test_retry_after_flood_sends_the_newest_text():
+    async def scenario():
+        limiter, telegram = TelegramRateLimiter(chat_rate=100, chat_burst=100), FakeTelegram()
+        telegram.flood[1] = 0.2
+        old = asyncio.create_task(limiter(telegram, None, _edit("1/3")))
+        await asyncio.sleep(0.05)
+        new = asyncio.create_task(limiter(telegram, None, _edit("2/3")))
+        await asyncio.gather(old, new)
+        return telegram.texts()
+
+    # Повтор после паузы уходит уже с текстом, поставленным во время паузы
+    assert asyncio.run(scenario()) == ["1/3", "2/3"]